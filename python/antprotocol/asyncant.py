@@ -0,0 +1,159 @@
+#################################################################
+# asynchronous ANT access
+# Runs the blocking ANT calls of each base in its own thread, and
+# hands back futures, so that one process can drive several bases
+# and do other work (web uploads) while the radio is busy.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import sys, threading, Queue
+
+class Future(object):
+    """Result of a call running in a Worker. result() waits for it,
+    and raises the exception of the call if it failed."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Future not done after %s seconds" % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Future not done after %s seconds" % timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) once done, right away if it already
+        is. Callbacks run in the thread completing the future."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+def completed(result):
+    """Returns a future already done with result"""
+    future = Future()
+    future.set_result(result)
+    return future
+
+def as_completed(futures, timeout=None):
+    """Yields the futures as they get done"""
+    done = Queue.Queue()
+    futures = list(futures)
+    for future in futures:
+        future.add_done_callback(done.put)
+    for i in range(len(futures)):
+        try:
+            yield done.get(True, timeout)
+        except Queue.Empty:
+            raise RuntimeError("Futures not done after %s seconds" % timeout)
+
+def wait(futures, timeout=None):
+    """Waits for all the futures, and returns their results in the
+    same order. The exception of the first failed one is raised."""
+    futures = list(futures)
+    for future in as_completed(futures, timeout):
+        pass
+    return [future.result() for future in futures]
+
+class Worker(object):
+    """A thread running calls one after the other. All the calls on a
+    base have to go through the same worker, as ANT commands and
+    their responses must not interleave."""
+
+    def __init__(self, name="ANT worker"):
+        self._calls = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, f, *args, **kwargs):
+        """Queues f(*args, **kwargs), returns its Future"""
+        future = Future()
+        self._calls.put((future, f, args, kwargs))
+        return future
+
+    def close(self):
+        """Stops the thread once the queued calls are done"""
+        self._calls.put(None)
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                return
+            future, f, args, kwargs = call
+            try:
+                result = f(*args, **kwargs)
+            except BaseException:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+
+class AsyncANT(object):
+    """Front end to an ANT object, running its calls in a Worker.
+    Every method returns a Future instead of blocking."""
+
+    def __init__(self, base, worker=None):
+        self.base = base
+        self.worker = worker or Worker("ANT worker %s" % base._chan)
+
+    def call(self, name, *args, **kwargs):
+        """Runs any method of the ANT object"""
+        return self.worker.submit(getattr(self.base, name), *args, **kwargs)
+
+    def send_acknowledged_data(self, l):
+        return self.call('send_acknowledged_data', l)
+
+    def receive_acknowledged_reply(self, size = 13):
+        return self.call('receive_acknowledged_reply', size)
+
+    def receive_burst(self):
+        """Resolves to the data of the next burst received"""
+        return self.call('_check_burst_response')
+
+    def send_burst_data(self, data):
+        return self.call('_send_burst_data', data)
+
+    def close(self):
+        """Closes the base once the pending calls are done"""
+        future = self.call('close')
+        self.worker.close()
+        return future
+
+# vim: set ts=4 sw=4 expandtab:
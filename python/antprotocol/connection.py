@@ -1,4 +1,5 @@
-import usb, os, sys
+import usb, os, sys, time, array, itertools, struct, errno, threading, random
+from message import MessageOUT, EXT_CHANNEL_ID, EXT_RSSI
 
 class ANTConnection(object):
     """ An abstract class that represents a connection """
@@ -19,6 +20,10 @@ class ANTConnection(object):
         """ Get some bytes """
         raise NotImplementedError()
 
+def timeout_error(message="Operation timed out"):
+    """Returns the USBError raised by pyusb when a read times out"""
+    return usb.USBError(message, errno=errno.ETIMEDOUT)
+
 class ANTUSBConnection(ANTConnection):
     ep = {
         'in'  : 0x81,
@@ -57,9 +62,7 @@ class ANTUSBConnection(ANTConnection):
             self._connection = None
 
     def send(self, command):
-        # libusb expects ordinals, it'll redo the conversion itself.
-        c = command
-        self._connection.write(self.ep['out'], map(ord, c), 0, 100)
+        self._connection.write(self.ep['out'], command, 0, 100)
 
     def receive(self, amount):
         return self._connection.read(self.ep['in'], amount, 0, self.timeout)
@@ -116,11 +119,855 @@ class FitBitANT(ANTUSBConnection):
         except usb.USBError:
             pass
 
+class SimulatedTracker(object):
+    """A FitBit tracker as seen through the air by the simulated
+    base. Holds the bank contents served on read opcodes, and the
+    state the tracker keeps between commands (channel id it hopped to,
+    pending burst data, sleep).
+
+    """
+
+    #: Channel id the tracker beacons on before being told to hop
+    DEFAULT_ID = [0xff, 0xff, 0x01, 0x01]
+
+    def __init__(self, banks=None, info=None, chunk_size=128, time_scale=0.0):
+        if banks is None:
+            banks = make_fixture_banks()
+        if info is None:
+            info = [0x01, 0x02, 0x03, 0x04, 0x05, 12, 4, 36, 4, 36, 0, 0]
+        #: bank index -> list of bytes, served on 0x22 opcodes
+        self.banks = dict((k, list(v)) for k, v in banks.items())
+        #: 12 bytes, served on the 0x24 opcode
+        self.info = list(info)
+        #: maximum amount of bytes sent back on one bank burst
+        self.chunk_size = chunk_size
+        #: bank index -> list of payloads written with 0x23
+        self.written = {}
+        #: False once the tracker has been carried away from the base
+        self.in_range = True
+        #: Signal strength the base receives the tracker with, in dBm
+        self.rssi = -60
+        self.time_scale = time_scale
+        self.reset()
+
+    def reset(self):
+        self.channel_id = list(self.DEFAULT_ID)
+        self.asleep_until = 0
+        self._pending = []
+        self._write_index = None
+
+    def beacons_on(self, channel_id):
+        """Tells if the tracker would answer on a channel configured
+        with channel_id (device number 0 acts as a wildcard)."""
+        if not self.in_range or time.time() < self.asleep_until:
+            return False
+        if channel_id[0:2] in ([0, 0], [0xff, 0xff]) and \
+           self.channel_id == self.DEFAULT_ID:
+            return True
+        return channel_id[0:2] == self.channel_id[0:2]
+
+    def handle_ack(self, data):
+        """Process 8 bytes of acknowledged data sent by the base.
+        Returns a list of (msgid, data) the tracker sends back, data
+        being without the channel number."""
+        if data[0] == 0x78:
+            if data[1] == 0x01:
+                self.reset()
+            elif data[1] == 0x02:
+                self.channel_id = data[2:4] + [0x01, 0x01]
+            return []
+        if data[0] == 0x7f:
+            self.asleep_until = time.time() + data[7] * self.time_scale
+            self.channel_id = list(self.DEFAULT_ID)
+            return []
+        pid, op = data[0], data[1:8]
+        if op[0] in (0x60, 0x70):
+            return self._burst(pid)
+        code = 0x41
+        if op[0] == 0x22:
+            self._pending = list(self.banks.get(op[1], []))
+            code = 0x42
+        elif op[0] == 0x24:
+            self._pending = list(self.info)
+            code = 0x42
+        elif op[0] == 0x23:
+            self._write_index = op[1]
+            code = 0x61
+        elif op[0] == 0x25:
+            self._erase(op[1], op[2] << 24 | op[3] << 16 | op[4] << 8 | op[5])
+        return [(0x4f, [pid, code, 0, 0, 0, 0, 0, 0])]
+
+    def handle_burst(self, data):
+        """Process a complete burst (concatenated packets, sequence
+        bytes stripped) sent by the base."""
+        pid, length = data[0], data[2]
+        payload = data[8:8+length]
+        if self._write_index is not None:
+            self.written.setdefault(self._write_index, []).append(payload)
+            self._write_index = None
+        return [(0x4f, [pid, 0x41, 0, 0, 0, 0, 0, 0])]
+
+    def _burst(self, pid):
+        chunk = self._pending[:self.chunk_size]
+        self._pending = self._pending[self.chunk_size:]
+        data = [pid, 0x81, len(chunk) & 0xff, len(chunk) >> 8, 0, 0, 0, 0]
+        data += chunk
+        while len(data) % 8:
+            data.append(0)
+        msgs = []
+        seq = itertools.cycle([0x20, 0x40, 0x60])
+        for i in range(0, len(data), 8):
+            if i == 0:
+                s = 0x00
+            else:
+                s = seq.next()
+            if i + 8 >= len(data):
+                s |= 0x80
+            msgs.append((0x50, [s] + data[i:i+8]))
+        return msgs
+
+    def _erase(self, index, tstamp):
+        data = self.banks.get(index)
+        if not data:
+            return
+        if index in (0, 6):
+            # Minute records prefixed with big endian timestamps
+            size = {0: 3, 6: 2}[index]
+            kept = []
+            i = 0
+            t = 0
+            while i < len(data):
+                if data[i] & 0x80:
+                    if t > tstamp:
+                        kept += data[i:i+size]
+                    i += size
+                    t += 60
+                    continue
+                t = data[i] << 24 | data[i+1] << 16 | data[i+2] << 8 | data[i+3]
+                if t > tstamp:
+                    kept += data[i:i+4]
+                i += 4
+            self.banks[index] = kept
+        elif index in (1, 2):
+            # Fixed size records prefixed with little endian timestamps
+            ultra = self.info[5] >= 12
+            size = {1: (14, 16), 2: (13, 15)}[index][ultra]
+            kept = []
+            for i in range(0, len(data), size):
+                d = data[i:i+size]
+                if (d[0] | d[1] << 8 | d[2] << 16 | d[3] << 24) > tstamp:
+                    kept += d
+            self.banks[index] = kept
+        else:
+            self.banks[index] = []
+
+
+def make_fixture_banks(start=None, minutes=24*60):
+    """Builds plausible bank contents for an ultra tracker covering
+    the minutes before start."""
+    if start is None:
+        start = int(time.time())
+    start -= start % 60
+    first = start - minutes * 60
+    bank0 = []
+    bank6 = []
+    for m in range(minutes):
+        t = first + m * 60
+        if m % 60 == 0:
+            bank0 += [t >> 24 & 0xff, t >> 16 & 0xff, t >> 8 & 0xff, t & 0xff]
+            bank6 += [t >> 24 & 0xff, t >> 16 & 0xff, t >> 8 & 0xff, t & 0xff]
+        bank0 += [0x81, 10 + (m * 7) % 40, (m * 13) % 120]
+        bank6 += [0x80, ((m % 3) == 0) and 10 or 0]
+    bank1 = []
+    for d in range(minutes / (24*60) + 1):
+        t = start - d * 24*60*60
+        steps = 5000 + d * 100
+        bank1 += [t & 0xff, t >> 8 & 0xff, t >> 16 & 0xff, t >> 24 & 0xff,
+                  0x9c, 0x41, steps & 0xff, steps >> 8 & 0xff, 0, 0,
+                  0x31, 0xe5, 0x49, 0x00, 0x1e, 0x00]
+    return {0: bank0, 1: bank1, 2: [], 6: bank6}
+
+
+def load_fixture_tracker(path):
+    """Builds a SimulatedTracker serving the bank contents recorded in
+    a connection dump, as written by FitBitClient.dump_connection,
+    either a transcript or a YAML dump from an older version."""
+    import transcript
+    banks = {}
+    info = None
+    for request in transcript.read_dump(path):
+        for op in request:
+            if op['status'] != 'success':
+                continue
+            opcode = op['request']['opcode']
+            if opcode[0] == 0x22:
+                banks[opcode[1]] = op['response']
+            elif opcode[0] == 0x24:
+                info = op['response']
+    return SimulatedTracker(banks, info)
+
+
+class SimulatedFitBitANT(ANTConnection):
+    """Class that emulates a FitBit base with a tracker in range,
+    without any hardware. Answers the ANT commands the way the base
+    does, and relays acknowledged and burst data to a
+    SimulatedTracker.
+
+    time_scale multiplies the real world timings (USB timeouts,
+    beacon and channel periods): 1.0 runs at the speed of the real
+    hardware, 0.0 as fast as possible.
+
+    """
+
+    NAME = "Simulator"
+
+    #: Seconds between two beacons of an idle tracker
+    BEACON_PERIOD = 1.0
+    #: Seconds for an ANT message to go over the air (channel period)
+    CHANNEL_PERIOD = 0x1000 / 32768.
+    #: Seconds the base takes to restart, at most according to the docs
+    RESET_TIME = 0.5
+    #: Seconds for a command to reach the base and its response to come
+    #: back over USB
+    RESPONSE_TIME = 0.004
+
+    def __init__(self, trackers=None, time_scale=0.0):
+        self.timeout = 1000
+        if trackers is None:
+            trackers = [SimulatedTracker(time_scale=time_scale)]
+        self.trackers = trackers
+        self.time_scale = time_scale
+        # receive() may be called from a ReadAheadConnection thread
+        self._lock = threading.Lock()
+        self._queue = []
+        #: (time, message) not received before time
+        self._delayed = []
+        self._channels = {}
+        self._bursts = {}
+        self._last_beacon = 0
+        self._sent = False
+        #: What is added to the data messages (ENABLE_EXT_RX_MESGS and
+        #: LIB_CONFIG flags)
+        self._extended = False
+        self._lib_config = 0
+        #: Amount of commands received, each costing a USB round trip
+        self.commands = 0
+
+    def open(self):
+        self._queue = []
+        self._channels = {}
+        self._extended = False
+        self._lib_config = 0
+        return True
+
+    def close(self):
+        self._queue = []
+
+    def _wait(self, seconds):
+        if self.time_scale:
+            time.sleep(seconds * self.time_scale)
+
+    def _queue_message(self, msgid, *data):
+        with self._lock:
+            self._queue += MessageOUT(msgid, *data).raw
+
+    def _queue_message_after(self, seconds, msgid, *data):
+        """Queues a message the base sends once seconds (scaled) passed"""
+        due = time.time() + seconds * self.time_scale
+        with self._lock:
+            self._delayed.append((due, MessageOUT(msgid, *data).raw))
+            self._delayed.sort()
+
+    def _release_delayed(self, until=None):
+        """Queues the delayed messages due until then (now by default)"""
+        if until is None:
+            until = time.time()
+        with self._lock:
+            while self._delayed and self._delayed[0][0] <= until:
+                self._queue += self._delayed.pop(0)[1]
+
+    def _channel(self, chan):
+        return self._channels.setdefault(chan, {'assigned': False, 'open': False,
+                                                'id': [0, 0, 0, 0]})
+
+    def send(self, command):
+        raw = list(bytearray(command))
+        msgid, data = raw[2], raw[3:-1]
+        self._sent = True
+        self.commands += 1
+        if msgid == 0x4a:
+            self._channels = {}
+            self._bursts = {}
+            self._extended = False
+            self._lib_config = 0
+            with self._lock:
+                self._delayed = []
+            self._queue_message_after(self.RESET_TIME, 0x6f, 0x20)
+            return
+        if msgid == 0x4f:
+            self._send_to_tracker(data[0], 'handle_ack', data[1:9])
+            return
+        if msgid == 0x50:
+            chan = data[0] & 0x1f
+            if chan not in self._bursts:
+                # The transfer starts on the next channel period
+                self._bursts[chan] = []
+                self._queue_message_after(self.CHANNEL_PERIOD, 0x40, chan,
+                                          0x01, 0x0a)
+            self._bursts[chan].extend(data[1:9])
+            if data[0] & 0x80:
+                # The transfer has started by the time it completes
+                self._release_delayed(time.time() + self.CHANNEL_PERIOD * self.time_scale)
+                self._send_to_tracker(chan, 'handle_burst', self._bursts.pop(chan))
+            return
+        if msgid == 0x4e:
+            # Broadcast data to the tracker, nobody listens
+            return
+        code = 0x00
+        if msgid in (0x41, 0x42, 0x4b, 0x4c, 0x51, 0x5b):
+            code = self._channel_command(msgid, data)
+        elif msgid == 0x66:
+            self._extended = bool(data[1])
+        elif msgid == 0x6e:
+            self._lib_config = data[1]
+        self._queue_message_after(self.RESPONSE_TIME, 0x40, data[0], msgid, code)
+        if msgid == 0x4c and code == 0x00:
+            # EVENT_CHANNEL_CLOSED, once the current period is over
+            self._queue_message_after(self.CHANNEL_PERIOD, 0x40, data[0],
+                                      0x01, 0x07)
+
+    def _channel_command(self, msgid, data):
+        """Applies a channel configuration command, returns the
+        response code, 0x15 being CHANNEL_IN_WRONG_STATE and 0x16
+        CHANNEL_NOT_OPENED."""
+        channel = self._channel(data[0])
+        if msgid == 0x42:
+            if channel['assigned']:
+                return 0x15
+            channel['assigned'] = True
+        elif msgid == 0x41:
+            if not channel['assigned'] or channel['open']:
+                return 0x15
+            channel['assigned'] = False
+        elif msgid == 0x51:
+            if not channel['assigned'] or channel['open']:
+                return 0x15
+            channel['id'] = data[1:5]
+        elif msgid in (0x4b, 0x5b):
+            if not channel['assigned'] or channel['open']:
+                return 0x15
+            channel['open'] = True
+            channel['scan'] = msgid == 0x5b
+        elif msgid == 0x4c:
+            if not channel['open']:
+                return 0x16
+            channel['open'] = False
+            channel['scan'] = False
+        return 0x00
+
+    def _tracker_on(self, chan):
+        """Returns the tracker listening on channel chan, if any"""
+        channel = self._channel(chan)
+        if not channel['open'] or channel.get('scan'):
+            return None
+        for tracker in self.trackers:
+            if tracker.beacons_on(channel['id']):
+                return tracker
+        return None
+
+    def _beacons_on(self, chan):
+        """Returns the trackers whose beacons are received on channel
+        chan, all those awake and in range in scan mode"""
+        channel = self._channel(chan)
+        if channel.get('scan'):
+            return [tracker for tracker in self.trackers
+                    if tracker.beacons_on(tracker.channel_id)]
+        tracker = self._tracker_on(chan)
+        return [tracker] if tracker is not None else []
+
+    def _queue_beacon(self, chan, tracker):
+        payload = [0x00, 0x58, 0xf7, 0x00, 0x00, 0x00, 0x00, 0x00]
+        if self._lib_config & (EXT_CHANNEL_ID | EXT_RSSI):
+            flag, ext = 0, []
+            if self._lib_config & EXT_CHANNEL_ID:
+                flag |= EXT_CHANNEL_ID
+                ext += tracker.channel_id
+            if self._lib_config & EXT_RSSI:
+                flag |= EXT_RSSI
+                ext += [0x20, tracker.rssi & 0xff, 0xb0]
+            self._queue_message(0x4e, chan, payload, flag, ext)
+        elif self._extended:
+            self._queue_message(0x5d, chan, tracker.channel_id, payload)
+        else:
+            self._queue_message(0x4e, chan, payload)
+
+    def _send_to_tracker(self, chan, handler, data):
+        self._wait(self.CHANNEL_PERIOD)
+        tracker = self._tracker_on(chan)
+        if tracker is None:
+            # EVENT_TRANSFER_TX_FAILED
+            self._queue_message(0x40, chan, 0x01, 0x06)
+            return
+        # EVENT_TRANSFER_TX_COMPLETED
+        self._queue_message(0x40, chan, 0x01, 0x05)
+        for msgid, reply in getattr(tracker, handler)(data):
+            if msgid == 0x50:
+                # Burst packets carry the sequence number in the upper bits
+                self._queue_message(msgid, reply[0] | chan, reply[1:])
+            else:
+                self._queue_message(msgid, chan, reply)
+
+    def _beacon_due(self):
+        """Tells if the tracker would have sent a beacon by now. When
+        running as fast as possible, the tracker beacons once between
+        two commands of the base."""
+        if self.time_scale:
+            return time.time() >= self._last_beacon + \
+                   self.BEACON_PERIOD * self.time_scale
+        return self._sent
+
+    def receive(self, amount):
+        deadline = time.time() + self.timeout / 1000. * self.time_scale
+        while True:
+            self._release_delayed()
+            with self._lock:
+                if self._queue:
+                    data = self._queue[:amount]
+                    self._queue = self._queue[amount:]
+                    return array.array('B', data)
+            # The tracker beacons once the base answered the last command
+            if self._beacon_due() and not self._delayed:
+                for chan in sorted(self._channels.keys()):
+                    for tracker in self._beacons_on(chan):
+                        self._queue_beacon(chan, tracker)
+                        self._last_beacon = time.time()
+                self._sent = False
+                if self._queue:
+                    continue
+            if time.time() >= deadline:
+                # Don't let a reader spin when running as fast as possible
+                time.sleep(0.001)
+                raise timeout_error()
+            time.sleep(0.001)
+
+#: Magic string starting capture files
+CAPTURE_MAGIC = 'ANTCAP1\n'
+#: direction, seconds since the capture started, frame length
+CAPTURE_RECORD = struct.Struct('<cdH')
+
+def read_capture(path):
+    """Yields the (direction, timestamp, bytes) records of a capture
+    file. direction is '>' for sent frames, '<' for received ones and
+    '!' for reads that timed out."""
+    f = open(path, 'rb')
+    try:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            direction, tstamp, length = CAPTURE_RECORD.unpack(header)
+            yield direction, tstamp, f.read(length)
+    finally:
+        f.close()
+
+class RecordingConnection(ANTConnection):
+    """Wraps another connection, and writes every frame going through
+    it, with its timestamp, to a capture file that can be fed back by
+    a ReplayConnection.
+
+    """
+
+    def __init__(self, connection, path):
+        self.connection = connection
+        self.path = path
+        self._file = None
+        self._start = None
+
+    def __getattr__(self, name):
+        # NAME, timeout, ... are the ones of the wrapped connection
+        return getattr(self.connection, name)
+
+    timeout = property(lambda self: self.connection.timeout,
+                       lambda self, value: setattr(self.connection,
+                                                   'timeout', value))
+
+    def _record(self, direction, data):
+        self._file.write(CAPTURE_RECORD.pack(direction,
+                                             time.time() - self._start,
+                                             len(data)))
+        self._file.write(data)
+
+    def open(self):
+        if not self.connection.open():
+            return False
+        self._file = open(self.path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._start = time.time()
+        return True
+
+    def close(self):
+        self.connection.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def send(self, command):
+        self._record('>', str(command))
+        return self.connection.send(command)
+
+    def receive(self, amount):
+        try:
+            data = self.connection.receive(amount)
+        except usb.USBError:
+            self._record('!', '')
+            raise
+        self._record('<', data.tostring())
+        return data
+
+class ReplayConnection(ANTConnection):
+    """Feeds back the frames received in a capture file. With
+    realtime, frames are delivered with the timing they were captured
+    with, otherwise as fast as possible. Sent frames are dropped.
+
+    """
+
+    NAME = "Replay"
+
+    def __init__(self, path, realtime=False):
+        self.path = path
+        self.realtime = realtime
+        self.timeout = 1000
+        self._records = None
+        self._start = None
+
+    def open(self):
+        self._records = ((d, t, b) for (d, t, b) in read_capture(self.path)
+                         if d != '>')
+        self._start = time.time()
+        return True
+
+    def close(self):
+        self._records = None
+
+    def send(self, command):
+        pass
+
+    def receive(self, amount):
+        try:
+            direction, tstamp, data = self._records.next()
+        except StopIteration:
+            raise timeout_error("End of capture")
+        if self.realtime:
+            delay = self._start + tstamp - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if direction == '!':
+            raise timeout_error()
+        return array.array('B', data)
+
+class FaultyConnection(ANTConnection):
+    """Wraps another connection, and damages the frames going through
+    it the way a noisy radio environment would, for the recovery code
+    to be benchmarked without hardware. Each received frame has a
+    probability of being dropped, having one byte corrupted or being
+    duplicated, reads may return only part of what was received, and
+    sent frames may be dropped. latency seconds are added to each read
+    from the wrapped connection and to each send. Given a seed, the
+    same faults are injected on each run.
+
+    """
+
+    #: Settings accepted by parse()
+    SETTINGS = ('drop', 'corrupt', 'duplicate', 'split', 'latency',
+                'send_drop', 'seed')
+
+    def __init__(self, connection, drop=0., corrupt=0., duplicate=0.,
+                 split=0., latency=0., send_drop=0., seed=None):
+        self.connection = connection
+        self.drop = drop
+        self.corrupt = corrupt
+        self.duplicate = duplicate
+        self.split = split
+        self.latency = latency
+        self.send_drop = send_drop
+        self.random = random.Random(seed)
+        #: fault -> times injected
+        self.injected = dict.fromkeys(('drop', 'corrupt', 'duplicate',
+                                       'split', 'send_drop'), 0)
+        #: Frames received from the wrapped connection
+        self.frames = 0
+        # Received bytes not making a whole frame yet, and the bytes
+        # to be returned by receive()
+        self._partial = bytearray()
+        self._pending = bytearray()
+
+    @classmethod
+    def parse(cls, connection, text):
+        """Wraps connection with the settings of text, as in
+        'drop=0.01 corrupt=0.005 seed=1'"""
+        kwargs = {}
+        for word in text.split():
+            name, value = word.split('=', 1)
+            if name not in cls.SETTINGS:
+                raise ValueError("Unknown fault %s" % name)
+            kwargs[name] = int(value) if name == 'seed' else float(value)
+        return cls(connection, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    timeout = property(lambda self: self.connection.timeout,
+                       lambda self, value: setattr(self.connection,
+                                                   'timeout', value))
+
+    def open(self):
+        return self.connection.open()
+
+    def close(self):
+        self._partial = bytearray()
+        self._pending = bytearray()
+        self.connection.close()
+
+    def send(self, command):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.send_drop and self.random.random() < self.send_drop:
+            self.injected['send_drop'] += 1
+            return len(command)
+        return self.connection.send(command)
+
+    def _frames(self):
+        """Takes the whole frames out of the bytes received. Bytes
+        before a sync byte are passed on as they are."""
+        buf = self._partial
+        frames = []
+        i = 0
+        while i < len(buf):
+            if buf[i] != 0xa4:
+                end = buf.find('\xa4', i + 1)
+                if end < 0:
+                    end = len(buf)
+            elif i + 1 < len(buf) and i + buf[i+1] + 4 <= len(buf):
+                end = i + buf[i+1] + 4
+            else:
+                break
+            frames.append(buf[i:end])
+            i = end
+        self._partial = buf[i:]
+        return frames
+
+    def _damage(self, frame):
+        """Adds frame to the pending bytes, or not, once or twice,
+        possibly corrupted"""
+        self.frames += 1
+        rnd = self.random
+        if self.drop and rnd.random() < self.drop:
+            self.injected['drop'] += 1
+            return
+        if self.corrupt and rnd.random() < self.corrupt:
+            self.injected['corrupt'] += 1
+            frame = bytearray(frame)
+            frame[rnd.randrange(len(frame))] ^= rnd.randint(1, 255)
+        self._pending += frame
+        if self.duplicate and rnd.random() < self.duplicate:
+            self.injected['duplicate'] += 1
+            self._pending += frame
+
+    def receive(self, amount):
+        while not self._pending:
+            if self.latency:
+                time.sleep(self.latency)
+            try:
+                self._partial.extend(self.connection.receive(amount))
+                frames = self._frames()
+            except usb.USBError:
+                if not self._partial:
+                    raise
+                # Nothing more coming, whatever was left goes as it is
+                frames = [self._partial]
+                self._partial = bytearray()
+            if not frames:
+                continue
+            for frame in frames:
+                self._damage(frame)
+            if not self._pending:
+                # All dropped, as if nothing came before the timeout
+                raise timeout_error()
+        n = min(amount, len(self._pending))
+        if n > 1 and self.split and self.random.random() < self.split:
+            self.injected['split'] += 1
+            n = self.random.randint(1, n - 1)
+        data = array.array('B', self._pending[:n])
+        del self._pending[:n]
+        return data
+
+    def __str__(self):
+        return "%d frames received, %s" % (
+            self.frames, ', '.join('%d %s' % (self.injected[name], name)
+                                   for name in sorted(self.injected.keys())))
+
+class RingBuffer(object):
+    """Preallocated byte FIFO shared between one writer and one reader
+    thread. The writer blocks while the buffer is full, and calls
+    tick() when it got nothing for a while."""
+
+    def __init__(self, size):
+        self._buf = bytearray(size)
+        self._size = size
+        self._start = 0
+        self._len = 0
+        self._ticks = 0
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def __len__(self):
+        return self._len
+
+    def write(self, data):
+        view = memoryview(bytearray(data))
+        while len(view):
+            with self._cond:
+                while self._len == self._size and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    return
+                end = (self._start + self._len) % self._size
+                n = min(len(view), self._size - self._len, self._size - end)
+                self._buf[end:end+n] = view[:n]
+                self._len += n
+                self._cond.notify_all()
+            view = view[n:]
+
+    def tick(self):
+        with self._cond:
+            self._ticks += 1
+            self._cond.notify_all()
+
+    def read(self, amount):
+        """Returns up to amount bytes as an array, waiting for some to
+        be available. Returns None if the writer ticked meanwhile."""
+        with self._cond:
+            ticks = self._ticks
+            while not self._len and not self.closed and self._ticks == ticks:
+                self._cond.wait()
+            n = min(amount, self._len)
+            if not n:
+                return None
+            first = min(n, self._size - self._start)
+            res = array.array('B', self._buf[self._start:self._start+first])
+            if first < n:
+                res.extend(array.array('B', self._buf[0:n-first]))
+            self._start = (self._start + n) % self._size
+            self._len -= n
+            self._cond.notify_all()
+            return res
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+class ReadAheadConnection(ANTConnection):
+    """Wraps another connection, with a thread constantly reading from
+    it into a ring buffer. receive() serves from that buffer, so that
+    the base is emptied while the caller is busy with a message.
+
+    """
+
+    def __init__(self, connection, size=65536, chunk=4096):
+        self.connection = connection
+        self.chunk = chunk
+        self._ring = RingBuffer(size)
+        self._thread = None
+        self._error = None
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    # The reader thread waits for as long as the wrapped connection
+    # does, so that is the one to change
+    timeout = property(lambda self: self.connection.timeout,
+                       lambda self, value: setattr(self.connection,
+                                                   'timeout', value))
+
+    def open(self):
+        if not self.connection.open():
+            return False
+        self.start()
+        return True
+
+    def start(self):
+        """Starts the reader thread on an already opened connection"""
+        self._thread = threading.Thread(target=self._reader,
+                                        name="ANT read-ahead")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _reader(self):
+        while not self._ring.closed:
+            try:
+                data = self.connection.receive(self.chunk)
+            except usb.USBError, e:
+                if e.errno == errno.ETIMEDOUT:
+                    self._ring.tick()
+                    continue
+                self._error = e
+                self._ring.close()
+                return
+            self._ring.write(data)
+
+    def close(self):
+        self._ring.close()
+        if self._thread is not None:
+            self._thread.join(self.timeout / 1000. + 1)
+            self._thread = None
+        self.connection.close()
+
+    def send(self, command):
+        return self.connection.send(command)
+
+    def receive(self, amount):
+        data = self._ring.read(amount)
+        if data is None:
+            if self._error is not None:
+                raise self._error
+            raise timeout_error()
+        return data
+
 CONNS = [FitBitANT, DynastreamANT]
 
 
-def getConn():
-    for conn in [bc() for bc in CONNS]:
+def getConn(simulate=None):
+    """Returns the first base found, or None. If simulate is true, or
+    the LIBFITBIT_SIMULATOR environment variable is set, a simulated
+    base is returned instead. The value of the variable can be the
+    path of a connection dump to serve the bank contents from.
+
+    If the LIBFITBIT_CAPTURE environment variable is set, all the
+    traffic with the base is recorded to the file it names.
+
+    If the LIBFITBIT_FAULTS environment variable is set, faults are
+    injected in the traffic with the base, as described by its value
+    (see FaultyConnection.parse()).
+
+    """
+    if simulate is None:
+        simulate = os.environ.get('LIBFITBIT_SIMULATOR')
+    conns = CONNS
+    if simulate:
+        trackers = None
+        if isinstance(simulate, basestring) and os.path.isfile(simulate):
+            trackers = [load_fixture_tracker(simulate)]
+        conns = [lambda: SimulatedFitBitANT(trackers)]
+    capture = os.environ.get('LIBFITBIT_CAPTURE')
+    if capture:
+        conns = [lambda bc=bc: RecordingConnection(bc(), capture) for bc in conns]
+    faults = os.environ.get('LIBFITBIT_FAULTS')
+    if faults:
+        conns = [lambda bc=bc: FaultyConnection.parse(bc(), faults) for bc in conns]
+    for conn in [bc() for bc in conns]:
         if conn.open():
             os.write(sys.stdout.fileno(), "\n%s: " % conn.NAME)
             return conn
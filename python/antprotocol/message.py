@@ -34,6 +34,9 @@ SLEEP_MESSAGE = 0xC5
 BROADCAST_DATA = 0x4E
 ACKNOWLEDGE_DATA = 0x4F
 BURST_TRANSFER_DATA = 0x50
+EXTENDED_BROADCAST_DATA = 0x5D
+EXTENDED_ACKNOWLEDGE_DATA = 0x5E
+EXTENDED_BURST_DATA = 0x5F
 
 CHANNEL_RESPONSE = 0x40
 
@@ -46,69 +49,213 @@ RESP_SERIAL_NUMBER = 0x61
 CW_INIT = 0x53
 CW_TEST = 0x48
 
+#: LIB_CONFIG flags, also flagging what follows the 8 bytes of a data
+#: message
+EXT_CHANNEL_ID = 0x80
+EXT_RSSI = 0x40
+EXT_TIMESTAMP = 0x20
+
+def checksum(raw):
+    """XOR of all the bytes of raw"""
+    return reduce(operator.xor, raw, 0)
+
 class Message(object):
-    def __init__(self):
-        self.sync = 0xa4
-        try:
-            # for MessageOUT
-            self.len = 0
-            self.cs = 0
-        except AttributeError:
-            pass
-        self.id = None
-        self.data = []
+    """An ANT message, kept as its raw bytes (sync, length, id, data
+    and checksum) in a bytearray."""
+
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    @property
+    def sync(self):
+        return self.raw[0]
+
+    @property
+    def len(self):
+        return self.raw[1]
+
+    @property
+    def id(self):
+        return self.raw[2]
+
+    @property
+    def data(self):
+        return self.raw[3:-1]
+
+    @property
+    def cs(self):
+        return self.raw[-1]
 
     def _raw(self, CS=False):
-        raw = [self.sync, self.len, self.id] + self.data
         if CS:
-            raw.append(self.cs)
-        return raw
+            return self.raw
+        return self.raw[:-1]
 
     def check_CS(self):
-        return reduce(operator.xor, self._raw()) == self.cs
+        return checksum(self.raw) == 0
 
     def toBytes(self):
-        return map(chr, self._raw(True))
+        return str(self.raw)
 
     def __str__(self):
-        return ' '.join(['%02X' % x for x in self._raw(True)])
+        return ' '.join(['%02X' % x for x in self.raw])
 
 
 class MessageIN(Message):
+    __slots__ = ()
+
     def __init__(self, raw):
-        Message.__init__(self)
+        """raw is a bytearray holding exactly one message"""
         assert len(raw) >= 4
         assert raw[1] == len(raw) - 4
-        self.sync = raw[0]
-        self.len = raw[1]
-        self.id = raw[2]
-        self.data = raw[3:-1]
-        self.cs = raw[-1]
+        Message.__init__(self, raw)
+
+    def extended(self):
+        """Returns (payload, channel id, rssi) of a data message: its 8
+        bytes, then the device number, device type and transmission
+        type of the sender, and the signal strength in dBm, as the
+        base gives them in extended messages. The channel id and rssi
+        are None if the base didn't give them."""
+        data = self.raw[3:-1]
+        if self.id in (EXTENDED_BROADCAST_DATA, EXTENDED_ACKNOWLEDGE_DATA,
+                       EXTENDED_BURST_DATA):
+            # Legacy format, the channel id comes before the payload
+            return (data[5:13],
+                    (data[1] | data[2] << 8, data[3], data[4]), None)
+        payload, channel_id, rssi = data[1:9], None, None
+        if len(data) > 9:
+            flag, i = data[9], 10
+            if flag & EXT_CHANNEL_ID:
+                channel_id = (data[i] | data[i+1] << 8, data[i+2], data[i+3])
+                i += 4
+            if flag & EXT_RSSI:
+                # Measurement type, then the signed value and threshold
+                rssi = data[i+1] - 256 if data[i+1] > 127 else data[i+1]
+        return payload, channel_id, rssi
 
     def __str__(self):
         return '<== ' + Message.__str__(self)
 
 class MessageOUT(Message):
-    def __init__(self, msgid, *data):
-        Message.__init__(self)
-        self.id = msgid
+    __slots__ = ()
 
-        for l in list(data):
-            if isinstance(l, list):
-                self.data += l
+    def __init__(self, msgid, *data):
+        raw = bytearray([0xa4, 0, msgid])
+        for l in data:
+            if isinstance(l, (list, bytearray)):
+                raw += bytearray(l)
             else:
-                self.data.append(l)
+                raw.append(l)
+        raw[1] = len(raw) - 3
+        raw.append(checksum(raw))
+        Message.__init__(self, raw)
 
+    def __str__(self):
+        return '==> ' + Message.__str__(self)
 
-    @property
-    def cs(self):
-        return reduce(operator.xor, self._raw())
+class FrameDecoder(object):
+    """Incremental decoder turning a stream of bytes read from the base
+    into MessageIN objects. Bytes that can't be part of a valid
+    message (no sync byte, unreasonable length, bad checksum) are
+    skipped by moving a cursor forward, the consumed bytes are only
+    dropped from the buffer once in a while.
 
+    """
 
-    @property
-    def len(self):
-        return len(self.data)
+    #: Bytes a message can start with
+    SYNC = ('\xa4', '\xa5')
+    #: Longest data field accepted, anything bigger is noise
+    MAX_LEN = 32
 
+    def __init__(self, compact_at=4096, debug=False):
+        self.compact_at = compact_at
+        self.debug = debug
+        #: Amount of bytes skipped while searching for a message
+        self.discarded = 0
+        #: Amount of candidate messages rejected
+        self.errors = 0
+        self._buf = bytearray()
+        self._pos = 0
 
-    def __str__(self):
-        return '==> ' + Message.__str__(self)
+    def __len__(self):
+        """Amount of bytes waiting to be decoded"""
+        return len(self._buf) - self._pos
+
+    def feed(self, data):
+        """Appends bytes (str, bytearray or array) to the stream"""
+        self._buf += buffer(data)
+
+    def _resync(self, start):
+        """Moves the cursor to the first sync byte at or after start"""
+        buf = self._buf
+        pos = len(buf)
+        for sync in self.SYNC:
+            i = buf.find(sync, start, pos)
+            if i != -1:
+                pos = i
+        if pos != self._pos:
+            if self.debug:
+                print "Searching for SYNC, discarding: " + \
+                      ' '.join(['%02X' % x for x in buf[self._pos:pos]])
+            self.discarded += pos - self._pos
+            self._pos = pos
+
+    def _compact(self):
+        pos = self._pos
+        if pos == len(self._buf) or \
+           (pos >= self.compact_at and pos * 2 >= len(self._buf)):
+            del self._buf[:pos]
+            self._pos = 0
+
+    def next(self):
+        """Returns the next message, or None if more bytes are needed"""
+        buf = self._buf
+        msg = None
+        while msg is None:
+            self._resync(self._pos)
+            pos = self._pos
+            if len(buf) - pos < 4:
+                break
+            l = buf[pos+1] + 4
+            if l > self.MAX_LEN + 4:
+                # Length doesn't look "reasonable"
+                self.errors += 1
+                self._resync(pos + 1)
+                continue
+            if len(buf) - pos < l:
+                break
+            frame = buf[pos:pos+l]
+            if checksum(frame) != 0:
+                if self.debug:
+                    print "Checksum error for proposed packet: ", \
+                          ' '.join(['%02X' % x for x in frame])
+                self.errors += 1
+                self._resync(pos + 1)
+                continue
+            self._pos = pos + l
+            msg = MessageIN(frame)
+        self._compact()
+        return msg
+
+    def salvage(self):
+        """Gives up on the partial messages waiting for more bytes, and
+        returns the first complete message found after them, or None if
+        nothing is left."""
+        while len(self):
+            self.errors += 1
+            self._resync(self._pos + 1)
+            msg = self.next()
+            if msg is not None:
+                return msg
+        self._compact()
+        return None
+
+    def __iter__(self):
+        """Yields the messages that can be decoded so far"""
+        while True:
+            msg = self.next()
+            if msg is None:
+                return
+            yield msg
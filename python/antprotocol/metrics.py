@@ -0,0 +1,177 @@
+#################################################################
+# metrics
+# Counters, gauges and latency histograms filled in by the ANT and
+# tracker code, and rendered in the Prometheus text format or as a
+# summary of what changed since a snapshot.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import time, threading
+
+#: Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram(object):
+    """Count and sum of the values observed, and how many fell in each
+    bucket (not cumulative, unlike the Prometheus ones)"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+class Timer(object):
+    """Context manager observing the time spent in its block, whether
+    it raised or not"""
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.time() - self.start
+        self.registry.observe(self.name, self.elapsed, **self.labels)
+        return False
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def _labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in labels)
+
+class Registry(object):
+    """All the metrics of the process, by name and labels. Safe to use
+    from several threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #: (name, labels) -> value
+        self.counters = {}
+        self.gauges = {}
+        #: (name, labels) -> Histogram
+        self.histograms = {}
+        #: name -> help text
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """Returns a context manager timing its block into histogram
+        name"""
+        return Timer(self, name, labels)
+
+    def snapshot(self):
+        """Returns the current values, to be given to summary() later"""
+        with self._lock:
+            return (dict(self.counters),
+                    dict((key, (h.count, h.sum))
+                         for key, h in self.histograms.items()))
+
+    def summary(self, since=None):
+        """Returns a dict of what changed since the snapshot since, for
+        json: counters by their increase, histograms by the amount, sum
+        and mean of the values observed, gauges by their value."""
+        counters, histograms = since or ({}, {})
+        result = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        with self._lock:
+            for key, value in sorted(self.counters.items()):
+                delta = value - counters.get(key, 0)
+                if delta:
+                    result['counters'][self._name(key)] = delta
+            for key, h in sorted(self.histograms.items()):
+                count, total = histograms.get(key, (0, 0.))
+                if h.count > count:
+                    result['histograms'][self._name(key)] = {
+                        'count': h.count - count,
+                        'sum': h.sum - total,
+                        'mean': (h.sum - total) / (h.count - count)}
+            for key, value in sorted(self.gauges.items()):
+                result['gauges'][self._name(key)] = value
+        return result
+
+    def _name(self, key):
+        return key[0] + _labels(key[1])
+
+    def prometheus(self):
+        """Returns all the metrics in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self.counters),
+                                  ('gauge', self.gauges),
+                                  ('histogram', self.histograms)):
+                described = set()
+                for key in sorted(metrics.keys()):
+                    name, labels = key
+                    if name not in described:
+                        described.add(name)
+                        if name in self.help:
+                            lines.append('# HELP %s %s' % (name, self.help[name]))
+                        lines.append('# TYPE %s %s' % (name, kind))
+                    if kind != 'histogram':
+                        lines.append('%s%s %s' % (name, _labels(labels),
+                                                  repr(metrics[key])))
+                        continue
+                    h = metrics[key]
+                    cumulative = 0
+                    for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (
+                            name, _labels(labels, [('le', bound)]), cumulative))
+                    lines.append('%s_sum%s %r' % (name, _labels(labels), h.sum))
+                    lines.append('%s_count%s %d' % (name, _labels(labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+#: Where the code of this package and of the client records its metrics
+registry = Registry()
+
+registry.describe('ant_retries_total',
+                  "Retries of the loops waiting for or resending ANT messages")
+registry.describe('fitbit_phase_seconds', "Time spent in each phase of a sync")
+registry.describe('fitbit_opcode_seconds', "Time spent running tracker opcodes")
+registry.describe('fitbit_http_seconds', "Round trips to the fitbit server")
+registry.describe('fitbit_bank_bytes_total', "Bytes of data banks read")
+registry.describe('fitbit_bank_bytes_per_second',
+                  "Transfer rate of the last data bank read")
+registry.describe('fitbit_syncs_total', "Syncs tried, by result")
+registry.describe('fitbit_trackers_seen', "Trackers heard during the last scan")
+
+# vim: set ts=4 sw=4 expandtab:
@@ -44,8 +44,11 @@
 # Added to and untwistedized and fixed up by Kyle Machulis <kyle@nonpolynomial.com>
 #
 
-import struct, array, time, os, sys
-from message import MessageIN, MessageOUT
+import struct, array, time, os, sys, threading, collections
+from message import MessageIN, MessageOUT, FrameDecoder
+from connection import ReadAheadConnection
+from retry import RetryPolicy
+from tracing import traced, install, PrintTracer
 
 class ANTException(Exception):
     """ Our Base Exception class """
@@ -69,34 +72,55 @@ def hexRepr(data):
 def intListToByteList(data):
     return map(lambda i: struct.pack('!H', i)[1], array.array('B', data))
 
-def log(f):
-    def wrapper(self, *args, **kwargs):
-        if self._debug:
-            print '  '*self._loglevel, "Start", f.__name__, args, kwargs
-        self._loglevel += 1
-        try:
-            res = f(self, *args, **kwargs)
-        except:
-            if self._debug:
-                print '  '*self._loglevel, "Fail", f.__name__
-            raise
-        finally:
-            self._loglevel -= 1
-        if self._debug:
-            print '  '*self._loglevel, "End", f.__name__, res
-        return res
-    return wrapper
-
 class ANT(object):
 
-    def __init__(self, connection, chan=0x00, debug=False):
+    #: Seconds the radio takes to send one burst packet, bursts run at
+    #: about 20kbps
+    BURST_PACKET_TIME = 64 / 20000.
+
+    def __init__(self, connection, chan=0x00, debug=False, readahead=False):
+        if readahead:
+            # Keep reading from the base while we process messages
+            connection = ReadAheadConnection(connection)
+            connection.start()
         self.connection = connection
         self._debug = debug
         self._chan = chan
 
         self._state = 0
-        self._receiveBuffer = []
-        self._loglevel = 0
+        #: None until the base has been reset, then 'unassigned',
+        #: 'assigned' or 'open'
+        self._channel_state = None
+        #: network -> key, and transmit power set since the last reset
+        self._network_keys = {}
+        self._transmit_power = None
+        #: Seconds between two messages on our channel, 4Hz by default
+        self._channel_period = 0x2000 / 32768.
+        self._decoder = FrameDecoder(debug=debug)
+        #: Tracer the calls and messages are reported to, if any
+        self.tracer = None
+        if debug:
+            self.set_tracer(PrintTracer())
+        #: Held while a tracker is searched for on the wildcard channel
+        #: id, so that two channels don't pair with the same one
+        self.pairing = threading.Lock()
+        #: How many times each operation is tried
+        self.retry = RetryPolicy()
+
+    def close(self):
+        self.connection.close()
+
+    def set_retry_policy(self, policy):
+        """Uses policy for the retry loops from now on, and its timeout
+        for the USB reads"""
+        self.retry = policy
+        self.connection.timeout = policy.usb_timeout
+
+    def set_tracer(self, tracer):
+        """Reports the calls and messages to tracer from now on, or to
+        nothing if it is None, in which case they cost nothing more"""
+        self.tracer = tracer
+        install(self, tracer)
 
     def _event_to_string(self, event):
         return { 0:"RESPONSE_NO_ERROR",
@@ -130,10 +154,16 @@ class ANT(object):
                  0x4b:"OPEN_CHANNEL"}.get(event, "%02x" % event)
 
     def _check_reset_response(self, status):
-        for tries in range(8):
+        # Whatever comes before the startup message was sent before the
+        # reset, and is dropped, up to a limit
+        timeouts = 0
+        for tries in self.retry.attempts('reset_response'):
             try:
                 msg = self._receive_message()
             except ReceiveException:
+                timeouts += 1
+                if timeouts >= self.retry['reset'].attempts:
+                    break
                 continue
             if msg.id == 0x6f and msg.data[0] == status:
                 return
@@ -143,84 +173,173 @@ class ANT(object):
         # response packets will always be 7 bytes
         msg = self._receive_message()
 
-        if msg.id == 0x40 and msg.len == 3 and msg.data[1:3] == [msgid, 0x00]:
+        if msg.id == 0x40 and msg.len == 3 and msg.raw[4] == msgid and msg.raw[5] == 0x00:
             return
 
-        raise StatusException("Message status %s does not match 0x0, 0x%x, 0x0 (NO_ERROR)" % (msg.data, msgid))
+        raise StatusException("Message status %s does not match 0x0, 0x%x, 0x0 (NO_ERROR)" % (list(msg.data), msgid))
 
-    @log
+    @traced
     def reset(self):
         self._send_message(0x4a, 0x00)
         # According to protocol docs, the system will take a maximum
-        # of .5 seconds to restart
-        #
-        # sleep time was 0.6, changed to 1.0 which reduces fail rate; a retry might
-        # be more sensible but wasn't sure if that might lead to possible duplicate 
-        # acknowledgements in the receive queue. A setting of 2.0 caused the interface 
-        # to not read fitbit devices. - Reed 31 Dec 2011
-        #
-        time.sleep(1.0)
-        #
-        # This is a requested reset, so we expect back 0x20
+        # of .5 seconds to restart, and sends a startup message once
+        # done. Rather than sleeping for long enough, we wait for
+        # it. This is a requested reset, so we expect back 0x20
         # (COMMAND_RESET)
+        self._channel_state = None
+        self._network_keys = {}
+        self._transmit_power = None
         self._check_reset_response(0x20)
+        self._channel_state = 'unassigned'
+
+    @traced
+    def reset_channel(self):
+        """Brings our channel back to its unassigned state. The whole
+        base is only reset the first time, or if the state of the
+        channel is unknown, as that takes over a second."""
+        if self._channel_state is None:
+            self.reset()
+            return
+        if self._channel_state == 'open':
+            self.close_channel()
+        if self._channel_state == 'assigned':
+            self.unassign_channel()
 
-    @log
+    @traced
     def set_channel_frequency(self, freq):
         self._send_message(0x45, self._chan, freq)
         self._check_ok_response(0x45)
 
-    @log
+    @traced
     def set_transmit_power(self, power):
+        if self._transmit_power == power:
+            return
         self._send_message(0x47, 0x0, power)
         self._check_ok_response(0x47)
+        self._transmit_power = power
 
-    @log
+    @traced
     def set_search_timeout(self, timeout):
         self._send_message(0x44, self._chan, timeout)
         self._check_ok_response(0x44)
 
-    @log
+    @traced
     def send_network_key(self, network, key):
+        if self._network_keys.get(network) == key:
+            return
         self._send_message(0x46, network, key)
         self._check_ok_response(0x46)
+        self._network_keys[network] = list(key)
 
-    @log
+    @traced
     def set_channel_period(self, period):
+        self._channel_period = (period[0] | period[1] << 8) / 32768.
         self._send_message(0x43, self._chan, period)
         self._check_ok_response(0x43)
 
-    @log
+    @traced
     def set_channel_id(self, id):
         self._send_message(0x51, self._chan, id)
         self._check_ok_response(0x51)
 
-    @log
+    @traced
     def open_channel(self):
         self._send_message(0x4b, self._chan)
         self._check_ok_response(0x4b)
+        self._channel_state = 'open'
 
-    @log
+    @traced
     def close_channel(self):
+        self._channel_state = None
         self._send_message(0x4c, self._chan)
         self._check_ok_response(0x4c)
+        # The channel can only be reused once it is actually closed
+        for tries in self.retry.attempts('close_channel'):
+            msg = self._receive_message()
+            if msg.id == 0x40 and msg.data[1] == 0x01 and msg.data[2] == 0x07:
+                self._channel_state = 'assigned'
+                return
+        raise StatusException("Failed to detect channel close")
+
+    @traced
+    def enable_extended_messages(self, enable=True):
+        """Has the base tell the channel id of the sender of each data
+        message it receives"""
+        self._send_message(0x66, 0x00, 0x01 if enable else 0x00)
+        self._check_ok_response(0x66)
+
+    @traced
+    def set_lib_config(self, flags):
+        """Chooses what the base adds to the data messages (EXT_* flags
+        of the message module), bases not supporting it fail with a
+        StatusException"""
+        self._send_message(0x6e, 0x00, flags)
+        self._check_ok_response(0x6e)
+
+    @traced
+    def open_rx_scan_mode(self):
+        """Has our channel, assigned and with a channel id set, receive
+        from all the devices in range matching that id, until it is
+        closed with close_rx_scan_mode(). Only channel 0 can scan."""
+        assert self._chan == 0, "scan mode runs on channel 0"
+        self._send_message(0x5b, self._chan)
+        self._check_ok_response(0x5b)
+        self._channel_state = 'open'
+
+    @traced
+    def close_rx_scan_mode(self):
+        """Closes the channel opened in scan mode. Messages received
+        from the devices in range keep coming until it is closed, and
+        are dropped."""
+        self._channel_state = None
+        self._send_message(0x4c, self._chan)
+        for tries in self.retry.attempts('close_scan'):
+            msg = self._receive_message()
+            if msg.id != 0x40 or msg.data[0] != self._chan:
+                continue
+            if msg.data[1] == 0x4c and msg.data[2] != 0x00:
+                raise StatusException("Failed to close the scan mode: %s" %
+                                      self._event_to_string(msg.data[2]))
+            if msg.data[1] == 0x01 and msg.data[2] == 0x07:
+                self._channel_state = 'assigned'
+                return
+        raise StatusException("Failed to detect channel close")
 
-    @log
+    def receive_scan(self):
+        """Returns (payload, channel id, rssi) of the next broadcast
+        received in scan mode (see MessageIN.extended()), or None if
+        another message came. Raises NoMessageException if nothing
+        came."""
+        msg = self._receive_message()
+        if msg.id not in (0x4e, 0x5d):
+            return None
+        return msg.extended()
+
+    @traced
     def assign_channel(self):
+        self._channel_state = None
         self._send_message(0x42, self._chan, 0x00, 0x00)
         self._check_ok_response(0x42)
+        self._channel_state = 'assigned'
+
+    @traced
+    def unassign_channel(self):
+        self._channel_state = None
+        self._send_message(0x41, self._chan)
+        self._check_ok_response(0x41)
+        self._channel_state = 'unassigned'
 
-    @log
+    @traced
     def receive_acknowledged_reply(self, size = 13):
-        for tries in range(30):
+        for tries in self.retry.attempts('acknowledged_reply'):
             msg = self._receive_message(size)
             if msg.len > 0 and msg.id == 0x4F:
                 return msg.data[1:]
         raise ReceiveException("Failed to receive acknowledged reply")
 
-    @log
-    def _check_tx_response(self, maxtries = 16):
-        for msgs in range(maxtries):
+    @traced
+    def _check_tx_response(self):
+        for msgs in self.retry.attempts('tx_response'):
             msg = self._receive_message()
             if msg.len > 1 and msg.id == 0x40:
                 if msg.data[2] == 0x0a: # TX Start
@@ -231,54 +350,83 @@ class ANT(object):
                     raise ReceiveException("Transmission Failed")
         raise ReceiveException("No Transmission Ack Seen")
 
-    @log
+    @traced
     def receive_bdcast(self):
         # FitBit device initialization
-        for tries in range(60):
+        for tries in self.retry.attempts('beacon'):
             os.write(sys.stdout.fileno(), '.')
             try:
                 msg = self._receive_message()
             except NoMessageException:
-               continue
+                continue
             if msg.id == 0x4E:
                 os.write(sys.stdout.fileno(), '!')
                 return
         raise FitBitBeaconTimeout("Timeout waiting for beacon, will restart")
 
-    @log
+    @traced
     def _send_burst_data(self, data, sleep = None):
-        for tries in range(2):
-            for l in range(0, len(data), 9):            
-                self._send_message(0x50, data[l:l+9])
-                # TODO: Should probably base this on channel timing
-                if sleep != None:
-                    time.sleep(sleep)
+        """Sends data as a burst of 9 bytes packets (channel and
+        sequence number, then 8 bytes). Unless sleep is given as a fixed
+        time between packets, the first one is sent on its own, and the
+        others once the radio reports it started the transfer, no faster
+        than the radio sends them."""
+        for tries in self.retry.attempts('burst_data'):
             try:
+                start = time.time()
+                for i, l in enumerate(range(0, len(data), 9)):
+                    if sleep is None and i == 1:
+                        start = self._wait_tx_start()
+                    elif sleep is None and i > 1:
+                        delay = start + (i - 1) * self.BURST_PACKET_TIME - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+                    self._send_message(0x50, data[l:l+9])
+                    if sleep != None:
+                        time.sleep(sleep)
                 self._check_tx_response()
             except ReceiveException:
                 continue
             return
         raise ReceiveException("Failed to send burst data")
 
-    @log
+    def _wait_tx_start(self):
+        """Waits for EVENT_TRANSFER_TX_START on our channel, which comes
+        on the first channel period after the first packet of a burst
+        got queued. Returns when it came."""
+        for tries in self.retry.attempts('tx_start'):
+            try:
+                msg = self._receive_message()
+            except NoMessageException:
+                break
+            if msg.len > 2 and msg.id == 0x40 and msg.data[1] == 0x01:
+                if msg.data[2] == 0x0a: # TX Start
+                    return time.time()
+                if msg.data[2] == 0x06: # TX failed
+                    raise ReceiveException("Transmission Failed")
+        # Never reported, the transfer started within a period anyway
+        time.sleep(self._channel_period)
+        return time.time()
+
+    @traced
     def _check_burst_response(self):
-        response = []
-        for tries in range(128):
+        response = bytearray()
+        for tries in self.retry.attempts('burst_response'):
             msg = self._receive_message()
             if msg.len > 1 and msg.id == 0x40 and msg.data[2] == 0x4:
                 raise ReceiveException("Burst receive failed by event!")
             elif msg.len > 0 and msg.id == 0x4f:
-                response = response + msg.data[1:]
+                response += msg.raw[4:-1]
                 return response
             elif msg.len > 0 and msg.id == 0x50:
-                response = response + msg.data[1:]
+                response += msg.raw[4:-1]
                 if msg.data[0] & 0x80:
                     return response
         raise ReceiveException("Burst receive failed to detect end")
 
-    @log
+    @traced
     def send_acknowledged_data(self, l):
-        for tries in range(8):
+        for tries in self.retry.attempts('acknowledged_data'):
             try:
                 self._send_message(0x4f, self._chan, l)
                 self._check_tx_response()
@@ -295,64 +443,222 @@ class ANT(object):
 
     def _send_message(self, msgid, *args):
         msg = MessageOUT(msgid, *args)
-        if self._debug:
-            print '  '*self._loglevel, msg
         return self.connection.send(msg.toBytes())
 
-    def _find_sync(self, buf, start=0):
-        i = 0;
-        for v in buf:
-            if i >= start and (v == 0xa4 or v == 0xa5):
-                break
-            i = i + 1
-        if i != 0:
-            if self._debug:
-                print "Searching for SYNC, discarding: " + hexRepr(buf[0:i])
-            del buf[0:i]
-        return buf
-
     def _receive_message(self, size = 4096):
         timeouts = 0
-        data = self._receiveBuffer
-        l = 4 # Minimum packet size (SYNC, LEN, CMD, CKSM)
+        decoder = self._decoder
         while True:
-            if len(data) < l:
-                # data[] too small, try to read some more
-                from usb.core import USBError
-                try:
-                    data += self.connection.receive(size).tolist()
-                    timeouts = 0
-                except USBError:
-                    timeouts = timeouts+1
-                    if timeouts > 3:
-                        # It looks like there isn't anything else coming.  Try
-                        # to find a plausable packet..
-                        data = self._find_sync(data)
-                        while len(data) > 1 and len(data) < data[1]+4:
-                            data = self._find_sync(data, 2)
-                        if len(data) == 0:
-                            # Failed to find anything..
-                            self._receiveBuffer = []
-                            raise NoMessageException()
-                continue
-            data = self._find_sync(data)
-            if len(data) < l: continue
-            if data[1] < 0 or data[1] > 32:
-                # Length doesn't look "reasonable"
-                data = self._find_sync(data, 1)
-                continue
-            l = data[1] + 4
-            if len(data) < l:
+            msg = decoder.next()
+            if msg is not None:
+                break
+            from usb.core import USBError
+            try:
+                decoder.feed(self.connection.receive(size))
+                if timeouts:
+                    self.retry.record('usb_receive', timeouts + 1, False)
+                timeouts = 0
+            except USBError:
+                timeouts = timeouts+1
+                if timeouts >= self.retry['usb_receive'].attempts:
+                    self.retry.record('usb_receive', timeouts, True)
+                    # It looks like there isn't anything else coming.  Try
+                    # to find a plausable packet..
+                    msg = decoder.salvage()
+                    if msg is None:
+                        # Failed to find anything..
+                        raise NoMessageException()
+                    break
+        return msg
+
+class ChannelQueue(object):
+    """Messages received for one channel, waiting to be processed by
+    the thread owning the channel."""
+
+    def __init__(self, heard=None):
+        self._msgs = collections.deque()
+        self._cond = threading.Condition()
+        self._ticks = 0
+        #: Returns when the base last delivered a message, on any
+        #: channel
+        self._heard = heard or time.time
+
+    def put(self, msg):
+        with self._cond:
+            self._msgs.append(msg)
+            self._cond.notify_all()
+
+    def tick(self):
+        """Tells the waiting thread that nothing came for a while"""
+        with self._cond:
+            self._ticks += 1
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Returns the next message, or None if nothing came for a
+        while on the whole base, or if the base delivered nothing at
+        all for timeout seconds"""
+        with self._cond:
+            ticks = self._ticks
+            start = time.time()
+            while not self._msgs and self._ticks == ticks:
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                # Messages for the other channels push the deadline
+                # back, they are only slower to come while others use
+                # the radio
+                left = max(start, self._heard()) + timeout - time.time()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            if self._msgs:
+                return self._msgs.popleft()
+            return None
+
+class ANTSession(ANT):
+    """Shares one base between several channels, each of them being
+    used by its own thread. The base is reset and configured once, then
+    a thread reads all the messages and dispatches them by channel
+    number to the ANTChannel objects given by channel().
+
+    """
+
+    def __init__(self, connection, debug=False, channels=8):
+        ANT.__init__(self, connection, None, debug)
+        self._free = range(channels)
+        #: channel -> its state when it was released
+        self._released = {}
+        self._queues = {}
+        self._system = ChannelQueue(self._last_heard)
+        self._heard = time.time()
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """Resets and configures the base, then starts dispatching the
+        messages"""
+        self.reset()
+        self.send_network_key(0, [0,0,0,0,0,0,0,0])
+        self.set_transmit_power(0x3)
+        self._running = True
+        self._thread = threading.Thread(target=self._dispatch,
+                                        name="ANT dispatcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.connection.close()
+
+    def channel(self):
+        """Returns an ANTChannel on a free channel number"""
+        with self._send_lock:
+            if not self._free:
+                raise ANTException("No free channel left")
+            chan = self._free.pop(0)
+            self._queues[chan] = ChannelQueue(self._last_heard)
+        return ANTChannel(self, chan, self._queues[chan],
+                          self._released.get(chan, 'unassigned'))
+
+    def release(self, channel, state='unassigned'):
+        with self._send_lock:
+            del self._queues[channel._chan]
+            self._released[channel._chan] = state
+            self._free.append(channel._chan)
+
+    def _channel_of(self, msg):
+        """Returns the channel number msg is about, or None"""
+        if msg.len < 1:
+            return None
+        if msg.id in (0x40, 0x4e, 0x4f):
+            return msg.data[0]
+        if msg.id == 0x50:
+            # Burst packets carry the sequence number in the upper bits
+            return msg.data[0] & 0x1f
+        return None
+
+    def _dispatch(self):
+        while self._running:
+            try:
+                msg = ANT._receive_message(self)
+            except NoMessageException:
+                for queue in self._queues.values() + [self._system]:
+                    queue.tick()
                 continue
-            msg = MessageIN(data[:l])
-            if not msg.check_CS():
-                if self._debug:
-                    print "Checksum error for proposed packet: ", msg
-                data = self._find_sync(data, 1)
+            self._heard = time.time()
+            queue = self._queues.get(self._channel_of(msg), self._system)
+            queue.put(msg)
+
+    def _last_heard(self):
+        return self._heard
+
+class ANTChannel(ANT):
+    """One channel of an ANTSession, to be used as the base of a FitBit
+    object. Commands affecting the whole base are left to the session.
+
+    """
+
+    def __init__(self, session, chan, queue, state='unassigned'):
+        ANT.__init__(self, session.connection, chan)
+        self._debug = session._debug
+        self.set_tracer(session.tracer)
+        self.retry = session.retry
+        self._channel_state = state
+        self.session = session
+        self.pairing = session.pairing
+        self._queue = queue
+
+    def close(self):
+        try:
+            self.reset_channel()
+        except ANTException:
+            # reset() will be tried by the next user of the channel
+            self._channel_state = None
+        self.session.release(self, self._channel_state)
+
+    def reset(self):
+        # The session resets the base once for all channels, only
+        # ours is brought back to its initial state, whatever it was
+        for command in (self.close_channel, self.unassign_channel):
+            try:
+                command()
+            except ANTException:
+                pass
+        self._channel_state = 'unassigned'
+
+    def send_network_key(self, network, key):
+        pass
+
+    def set_transmit_power(self, power):
+        pass
+
+    def _check_ok_response(self, msgid):
+        # Other channels keep the radio busy, so beacons and events of
+        # this channel may come before the response
+        for tries in self.retry.attempts('ok_response'):
+            msg = self._receive_message()
+            if msg.id == 0x4e or (msg.id == 0x40 and msg.data[1] == 0x01):
                 continue
-            # save the rest for later
-            self._receiveBuffer = data[l:]
-            if self._debug:
-                print '  '*self._loglevel, msg
-            return msg
+            if msg.id == 0x40 and msg.len == 3 and msg.raw[4] == msgid and msg.raw[5] == 0x00:
+                return
+            break
+        raise StatusException("Message status %s does not match 0x0, 0x%x, 0x0 (NO_ERROR)" % (list(msg.data), msgid))
 
+    def _send_message(self, msgid, *args):
+        with self.session._send_lock:
+            return ANT._send_message(self, msgid, *args)
+
+    def _receive_message(self, size = 4096):
+        # The base keeps receiving for the other channels, so we give
+        # up once it delivered nothing for as long as a lone channel
+        # would wait for it
+        msg = self._queue.get(self.retry['usb_receive'].attempts *
+                              self.connection.timeout / 1000.)
+        if msg is None:
+            raise NoMessageException()
+        return msg
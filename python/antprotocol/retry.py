@@ -0,0 +1,193 @@
+#################################################################
+# retry policy
+# How many times each ANT operation is tried, for how long, and how
+# long to wait between two tries, with statistics of how many tries
+# the operations actually took.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import time, random, threading
+from metrics import registry
+
+class Retry(object):
+    """Limits of one retry loop. At most attempts tries, and no new
+    try once deadline seconds went by since the first one. Before try
+    n (counting from 0), backoff * factor ** (n - 1) seconds are
+    waited, at most max_backoff, a random fraction jitter of it being
+    taken off.
+
+    """
+
+    def __init__(self, attempts, deadline=None, backoff=0., factor=2.,
+                 max_backoff=1., jitter=0.):
+        self.attempts = attempts
+        self.deadline = deadline
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempt, rnd=random):
+        """Returns the seconds to wait before try attempt"""
+        if attempt == 0 or not self.backoff:
+            return 0.
+        delay = min(self.backoff * self.factor ** (attempt - 1),
+                    self.max_backoff)
+        if self.jitter:
+            delay -= delay * self.jitter * rnd.random()
+        return delay
+
+    def copy(self, **changes):
+        values = dict(self.__dict__)
+        values.update(changes)
+        return Retry(**values)
+
+    @classmethod
+    def parse(cls, text):
+        """Builds a Retry from 'attempts [name=value ...]', as in
+        '8 deadline=2 backoff=0.01 jitter=0.5'"""
+        words = text.split()
+        kwargs = {'attempts': int(words[0])}
+        for word in words[1:]:
+            name, value = word.split('=', 1)
+            if name not in ('deadline', 'backoff', 'factor', 'max_backoff',
+                            'jitter'):
+                raise ValueError("Unknown retry setting %s" % name)
+            kwargs[name] = float(value)
+        return cls(**kwargs)
+
+    def __str__(self):
+        text = '%d' % self.attempts
+        for name in ('deadline', 'backoff', 'factor', 'max_backoff', 'jitter'):
+            value = getattr(self, name)
+            if value != getattr(DEFAULT_RETRY, name):
+                text += ' %s=%g' % (name, value)
+        return text
+
+DEFAULT_RETRY = Retry(1)
+
+class RetryStats(object):
+    """What the loops of one operation did"""
+
+    def __init__(self):
+        #: Loops run, and those which ran out of tries
+        self.calls = 0
+        self.exhausted = 0
+        #: Tries in all the loops, and the most in one
+        self.attempts = 0
+        self.max_attempts = 0
+        #: Seconds waited between tries
+        self.slept = 0.
+
+    def record(self, attempts, exhausted, slept=0.):
+        self.calls += 1
+        if exhausted:
+            self.exhausted += 1
+        self.attempts += attempts
+        self.max_attempts = max(self.max_attempts, attempts)
+        self.slept += slept
+
+class RetryPolicy(object):
+    """The Retry of each operation of ANT and FitBit, by name. Can be
+    changed at any time, the loops read it when they start."""
+
+    #: The limits the code always had
+    DEFAULTS = {
+        'acknowledged_data': Retry(8),      # ANT.send_acknowledged_data
+        'tx_response': Retry(16),           # messages before TX done
+        'acknowledged_reply': Retry(30),    # messages before the reply
+        'beacon': Retry(60),                # messages before a beacon
+        'burst_response': Retry(128),       # messages of a burst
+        'burst_data': Retry(2),             # ANT._send_burst_data
+        'tx_start': Retry(16),              # messages before TX start
+        'close_channel': Retry(16),         # messages before the close
+        'close_scan': Retry(256),           # same, with beacons coming in
+        'reset': Retry(8),                  # timeouts before the startup
+        'reset_response': Retry(256),       # messages before the startup
+        'ok_response': Retry(16),           # messages before a response
+        'usb_receive': Retry(4),            # USB timeouts in a row, only
+                                            # attempts applies
+        'run_opcode': Retry(4),             # FitBit.run_opcode
+        }
+
+    #: Milliseconds of one USB read
+    USB_TIMEOUT = 1000
+
+    def __init__(self, retries=None, usb_timeout=None, rnd=None):
+        self.retries = dict(self.DEFAULTS)
+        self.retries.update(retries or {})
+        self.usb_timeout = usb_timeout or self.USB_TIMEOUT
+        self.rnd = rnd or random.Random()
+        #: name -> RetryStats
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self.retries[name]
+
+    def set(self, name, retry=None, **changes):
+        """Replaces the Retry of name by retry, or changes some of its
+        settings"""
+        if retry is None:
+            retry = self.retries[name].copy(**changes)
+        self.retries[name] = retry
+
+    def record(self, name, attempts, exhausted, slept=0.):
+        """Adds a loop of name to the statistics"""
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = RetryStats()
+            stats.record(attempts, exhausted, slept)
+        if attempts > 1:
+            registry.inc('ant_retries_total', attempts - 1, loop=name)
+
+    def attempts(self, name):
+        """Yields the number of each try of operation name, waiting the
+        backoff before each one, until the limits are reached. Meant to
+        be looped over, the loop being left once done with:
+
+            for attempt in policy.attempts('acknowledged_data'):
+                ...
+                return
+            raise ...
+
+        Loops which get to the end ran out of tries.
+        """
+        retry = self.retries[name]
+        start = time.time()
+        slept = 0.
+        attempt = 0
+        try:
+            while attempt < retry.attempts:
+                if attempt:
+                    if retry.deadline is not None and \
+                       time.time() - start >= retry.deadline:
+                        break
+                    delay = retry.delay(attempt, self.rnd)
+                    if delay > 0:
+                        time.sleep(delay)
+                        slept += delay
+                attempt += 1
+                yield attempt - 1
+        except GeneratorExit:
+            # The loop was left before the end
+            self.record(name, attempt, False, slept)
+            raise
+        self.record(name, attempt, True, slept)
+
+    def __str__(self):
+        lines = ["%-20s %7s %9s %8s %6s %8s" % (
+            'operation', 'loops', 'exhausted', 'tries', 'max', 'slept')]
+        with self._lock:
+            for name in sorted(self.stats.keys()):
+                s = self.stats[name]
+                lines.append("%-20s %7d %9d %8d %6d %7.3fs" % (
+                    name, s.calls, s.exhausted, s.attempts,
+                    s.max_attempts, s.slept))
+        return '\n'.join(lines)
+
+# vim: set ts=4 sw=4 expandtab:
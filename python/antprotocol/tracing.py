@@ -0,0 +1,177 @@
+#################################################################
+# tracing
+# Hooks called on the ANT calls and messages of an ANT object, once
+# a tracer is set on it. Without one, nothing is wrapped and the
+# calls cost nothing more.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import sys, time, threading, collections
+from message import MessageOUT
+
+def traced(f):
+    """Marks a method of ANT as a span, reported to the tracer of the
+    object once it has one"""
+    f.traced = True
+    return f
+
+class Tracer(object):
+    """Receives the events of an ANT object. Every hook does nothing
+    here, subclasses pick the ones they want."""
+
+    def span_start(self, ant, name, args, kwargs):
+        pass
+
+    def span_end(self, ant, name, result):
+        pass
+
+    def span_fail(self, ant, name, exc_info):
+        pass
+
+    def message_out(self, ant, msgid, args):
+        """Called with the arguments of _send_message, the message
+        being built only by the tracers which need it"""
+        pass
+
+    def message_in(self, ant, msg):
+        pass
+
+class MultiTracer(Tracer):
+    """Hands the events over to several tracers"""
+
+    def __init__(self, *tracers):
+        self.tracers = tracers
+
+    def span_start(self, ant, name, args, kwargs):
+        for t in self.tracers:
+            t.span_start(ant, name, args, kwargs)
+
+    def span_end(self, ant, name, result):
+        for t in self.tracers:
+            t.span_end(ant, name, result)
+
+    def span_fail(self, ant, name, exc_info):
+        for t in self.tracers:
+            t.span_fail(ant, name, exc_info)
+
+    def message_out(self, ant, msgid, args):
+        for t in self.tracers:
+            t.message_out(ant, msgid, args)
+
+    def message_in(self, ant, msg):
+        for t in self.tracers:
+            t.message_in(ant, msg)
+
+class PrintTracer(Tracer):
+    """Prints the calls, indented by depth, and the messages, as the
+    debug mode always did"""
+
+    def __init__(self, out=None):
+        self.out = out
+        self._depth = threading.local()
+
+    def _print(self, *values):
+        depth = getattr(self._depth, 'value', 0)
+        out = self.out or sys.stdout
+        out.write('  ' * depth + ' ' + ' '.join(str(v) for v in values) + '\n')
+
+    def span_start(self, ant, name, args, kwargs):
+        self._print("Start", name, args, kwargs)
+        self._depth.value = getattr(self._depth, 'value', 0) + 1
+
+    def span_end(self, ant, name, result):
+        self._depth.value -= 1
+        self._print("End", name, result)
+
+    def span_fail(self, ant, name, exc_info):
+        self._print("Fail", name)
+        self._depth.value -= 1
+
+    def message_out(self, ant, msgid, args):
+        self._print(MessageOUT(msgid, *args))
+
+    def message_in(self, ant, msg):
+        self._print(msg)
+
+class FlightRecorder(Tracer):
+    """Keeps the last size events, to be dumped once something went
+    wrong. Events are only formatted when dumped."""
+
+    def __init__(self, size=512):
+        self.events = collections.deque(maxlen=size)
+
+    def span_start(self, ant, name, args, kwargs):
+        self.events.append((time.time(), ant._chan, 'start', name, args))
+
+    def span_end(self, ant, name, result):
+        self.events.append((time.time(), ant._chan, 'end', name, None))
+
+    def span_fail(self, ant, name, exc_info):
+        self.events.append((time.time(), ant._chan, 'fail', name, exc_info[1]))
+
+    def message_out(self, ant, msgid, args):
+        self.events.append((time.time(), ant._chan, 'out', msgid, args))
+
+    def message_in(self, ant, msg):
+        self.events.append((time.time(), ant._chan, 'in', None, msg))
+
+    def clear(self):
+        self.events.clear()
+
+    def dump(self, out):
+        """Writes the events recorded to the file out, oldest first"""
+        events = list(self.events)
+        if not events:
+            return
+        start = events[0][0]
+        for t, chan, kind, name, details in events:
+            if kind == 'out':
+                name, details = None, MessageOUT(name, *details)
+            line = '%10.6f chan %s %-5s' % (t - start, chan, kind)
+            if name is not None:
+                line += ' ' + name
+            if details is not None:
+                line += ' ' + str(details)
+            out.write(line + '\n')
+
+def install(ant, tracer):
+    """Makes the traced methods and the messages of ant report to
+    tracer, or removes the hooks if tracer is None"""
+    names = [name for name in dir(type(ant))
+             if getattr(getattr(type(ant), name), 'traced', False)]
+    for name in names + ['_send_message', '_receive_message']:
+        if name in ant.__dict__:
+            del ant.__dict__[name]
+    if tracer is None:
+        return
+    for name in names:
+        setattr(ant, name, _traced_call(ant, name, getattr(ant, name), tracer))
+    send = ant._send_message
+    receive = ant._receive_message
+    def _send_message(msgid, *args):
+        tracer.message_out(ant, msgid, args)
+        return send(msgid, *args)
+    def _receive_message(*args, **kwargs):
+        msg = receive(*args, **kwargs)
+        tracer.message_in(ant, msg)
+        return msg
+    ant._send_message = _send_message
+    ant._receive_message = _receive_message
+
+def _traced_call(ant, name, method, tracer):
+    def call(*args, **kwargs):
+        tracer.span_start(ant, name, args, kwargs)
+        try:
+            result = method(*args, **kwargs)
+        except:
+            tracer.span_fail(ant, name, sys.exc_info())
+            raise
+        tracer.span_end(ant, name, result)
+        return result
+    call.__name__ = name
+    return call
+
+# vim: set ts=4 sw=4 expandtab:
@@ -0,0 +1,206 @@
+#################################################################
+# bank decoder
+# Decodes the content of the tracker data banks into columns of
+# values, one array per field, instead of one dict per record.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import array, struct, datetime, itertools
+
+# Maps every byte with its MSB set to 1, the others to 0
+_MSB = bytearray([x >> 7 for x in range(256)])
+# Clears the MSB of every byte
+_LOW7 = bytearray([x & 0x7f for x in range(256)])
+# Maps every byte to a tenth of it
+_TENTH = bytearray([x / 10 for x in range(256)])
+# Active score for each value of the second byte of bank 0 records
+_SCORE = [(x - 10) / 10. for x in range(256)]
+
+def ifromtimestamps(tstamps):
+    """Yields the local datetimes of a sequence of timestamps. Local
+    time only jumps on hour boundaries, so it is enough to convert one
+    timestamp per hour, and to add the minutes and seconds to it."""
+    hours = {}
+    deltas = {}
+    for t in tstamps:
+        offset = t % 3600
+        hour = hours.get(t - offset)
+        if hour is None:
+            hour = hours[t - offset] = datetime.datetime.fromtimestamp(t - offset)
+        delta = deltas.get(offset)
+        if delta is None:
+            delta = deltas[offset] = datetime.timedelta(seconds=offset)
+        yield hour + delta
+
+def fromtimestamps(tstamps):
+    """Returns the local datetimes of a sequence of timestamps"""
+    return list(ifromtimestamps(tstamps))
+
+class RecordBatch(object):
+    """Decoded records of one bank, stored as columns: name -> array,
+    all of the same length. Datetimes are only built when asked for.
+
+    """
+
+    def __init__(self, columns, segments=None):
+        self.columns = columns
+        #: (record index, timestamp) for each timestamp found in a
+        #: minute bank
+        self.segments = segments or []
+
+    def __len__(self):
+        return len(self.columns['timestamp'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def datetimes(self):
+        return fromtimestamps(self.columns['timestamp'])
+
+    def newest(self):
+        """Returns the newest timestamp of the batch, or None"""
+        if not len(self):
+            return None
+        return max(self.columns['timestamp'])
+
+    def rows(self, names=None):
+        """Yields one dict per record, with the columns in names (all
+        by default) plus 'datetime'."""
+        if names is None:
+            names = self.columns.keys()
+        keys = list(names) + ['datetime']
+        columns = [self.columns[n] for n in names] + \
+                  [ifromtimestamps(self.columns['timestamp'])]
+        for values in itertools.izip(*columns):
+            yield dict(itertools.izip(keys, values))
+
+def _minute_records(data, size):
+    """Splits a bank made of big endian timestamps followed by runs of
+    size bytes records with their MSB set. Returns the timestamp
+    column, one bytearray per byte of the records, and the segments."""
+    data = bytearray(data)
+    tstamps = array.array('L')
+    fields = [bytearray() for i in range(size)]
+    segments = []
+    i = 0
+    while i + 4 <= len(data):
+        if data[i] & 0x80:
+            # Records without any timestamp before them
+            tstamp = 0
+        else:
+            tstamp = struct.unpack_from('>I', data, i)[0]
+            segments.append((len(tstamps), tstamp))
+            i += 4
+        # The run of records ends at the first byte without its MSB
+        # set, looking only at the first byte of each record, in
+        # windows growing until the end is found.
+        n = 0
+        window = 64
+        while True:
+            marks = data[i+n*size:i+(n+window)*size:size].translate(_MSB)
+            end = marks.find('\x00')
+            if end != -1:
+                n += end
+                break
+            n += len(marks)
+            if len(marks) < window:
+                break
+            window *= 2
+        n = min(n, (len(data) - i) / size)
+        end = i + n * size
+        tstamps.extend(xrange(tstamp, tstamp + 60 * n, 60))
+        for j in range(size):
+            fields[j] += data[i+j:end:size]
+        i = end
+    return tstamps, fields, segments
+
+def decode_bank0(data):
+    """Minute records of steps and active score"""
+    tstamps, (unknown, score, steps), segments = _minute_records(data, 3)
+    return RecordBatch({
+        'timestamp': tstamps,
+        # First byte always has its MSB set, its meaning is unknown
+        '?': array.array('B', str(unknown.translate(_LOW7))),
+        # METs start at 1 but 1 is subtracted per minute
+        'score': array.array('d', map(_SCORE.__getitem__, score)),
+        'steps': array.array('B', str(steps)),
+        }, segments)
+
+def decode_bank6(data):
+    """Minute records of floors climbed"""
+    tstamps, (marker, floors), segments = _minute_records(data, 2)
+    return RecordBatch({
+        'timestamp': tstamps,
+        'floors': array.array('B', str(floors.translate(_TENTH))),
+        }, segments)
+
+def decode_bank1(data, hardware_version=12):
+    """Daily statistics, 16 bytes per record on the ultra, 14 on the
+    older trackers which don't count floors."""
+    ultra = hardware_version >= 12
+    data = bytearray(data)
+    if ultra:
+        record = struct.Struct('<IHIIH')
+    else:
+        record = struct.Struct('<IHII')
+    values = [record.unpack_from(data, i)
+              for i in range(0, len(data) - record.size + 1, record.size)]
+    columns = zip(*values) or [()] * 5
+    floors = [0] * len(values)
+    if ultra:
+        floors = [x / 10 for x in columns[4]]
+    return RecordBatch({
+        'timestamp': array.array('L', columns[0]),
+        'calories_raw': array.array('L', columns[1]),
+        'calories': array.array('d', [x * .1103 - 7 for x in columns[1]]),
+        'steps': array.array('L', columns[2]),
+        'distance': array.array('d', [x / 1000000. for x in columns[3]]),
+        'floors': array.array('L', floors),
+        })
+
+def bank2_record_size(hardware_version=12):
+    """Bytes of a bank 2 record: 15 on the ultra, 13 on the older
+    trackers"""
+    return 15 if hardware_version >= 12 else 13
+
+def decode_bank2(data, hardware_version=12):
+    """Recorded activities (see bank2_record_size()). Only the records
+    of kind 1 (end of an activity) have elapsed, steps, distance and
+    floors set."""
+    ultra = hardware_version >= 12
+    size = bank2_record_size(hardware_version)
+    data = bytearray(data)
+    columns = dict((name, array.array('L')) for name in
+                   ('timestamp', 'kind', 'elapsed', 'steps', 'floors'))
+    columns['distance'] = array.array('d')
+    for i in range(0, len(data) - size + 1, size):
+        tstamp, elapsed, kind = struct.unpack_from('<IHB', data, i)
+        steps = dist = floors = 0
+        if kind == 1:
+            steps = data[i+7] | data[i+8] << 8 | data[i+9] << 16
+            dist = (data[i+10] | data[i+11] << 8 | data[i+12] << 16) / 100000.
+            if ultra:
+                floors = struct.unpack_from('<H', data, i+13)[0] / 10
+        else:
+            elapsed = 0
+        for name, value in (('timestamp', tstamp), ('kind', kind),
+                            ('elapsed', elapsed), ('steps', steps),
+                            ('distance', dist), ('floors', floors)):
+            columns[name].append(value)
+    return RecordBatch(columns)
+
+DECODERS = {0: decode_bank0,
+            1: decode_bank1,
+            2: decode_bank2,
+            6: decode_bank6}
+
+def decode(index, data, hardware_version=12):
+    """Decodes bank index, which must be one of DECODERS"""
+    if index in (1, 2):
+        return DECODERS[index](data, hardware_version)
+    return DECODERS[index](data)
+
+# vim: set ts=4 sw=4 expandtab:
@@ -1,4 +1,5 @@
 import ConfigParser, os
+from antprotocol.retry import Retry, RetryPolicy
 
 class ClientConfig(object):
     """
@@ -7,16 +8,151 @@ class ClientConfig(object):
     [output]
     dump_connection = True
     write_csv = False
+    streaming = False
+
+    [base]
+    readahead = False
+    flight_recorder = 512
+
+    [sync]
+    incremental = False
+    pipeline = False
+
+    [http]
+    keepalive = True
+    timeout = 30
+
+    [queue]
+    enabled = True
+    batch = 8
+    concurrency = 2
+
+    [schedule]
+    min_wait = 3
+    max_wait = 300
+
+    [metrics]
+    port = 0
+    summary = False
+
+    [discovery]
+    scan = False
+    scan_time = 2
+
+    [retry]
+    usb_timeout = 1000
+    acknowledged_data = 8 backoff=0.01 jitter=0.5
+    beacon = 60 deadline=90
     """
     
     def __init__(self):        
-        self.parser = ConfigParser.SafeConfigParser({'dump_connection':False, 'write_csv':False})
+        self.parser = ConfigParser.SafeConfigParser({'dump_connection':'False', 'write_csv':'False',
+                                                     'streaming':'False',
+                                                     'readahead':'False', 'flight_recorder':'512',
+                                                     'incremental':'False',
+                                                     'pipeline':'False', 'keepalive':'True',
+                                                     'timeout':'30', 'enabled':'True',
+                                                     'batch':'8', 'concurrency':'2',
+                                                     'min_wait':'3', 'max_wait':'300',
+                                                     'port':'0', 'summary':'False',
+                                                     'usb_timeout':'1000',
+                                                     'scan':'False', 'scan_time':'2'})
         config_path = os.path.expanduser('~/.fitbit/config')
         if os.path.exists(config_path):         
             self.parser.read(config_path)
+        for section in ('output', 'base', 'sync', 'http', 'queue', 'schedule',
+                        'metrics', 'discovery', 'retry'):
+            if not self.parser.has_section(section):
+                self.parser.add_section(section)
     
     def dump_connection(self):
         return self.parser.getboolean('output', 'dump_connection')
     
     def write_csv(self):
         return self.parser.getboolean('output', 'write_csv')
+
+    def streaming(self):
+        """Keep the tracker responses on disk instead of in memory
+        during the sync, so that its memory use doesn't grow with the
+        amount of data on the tracker"""
+        return self.parser.getboolean('output', 'streaming')
+
+    def readahead(self):
+        return self.parser.getboolean('base', 'readahead')
+
+    def flight_recorder(self):
+        """Last ANT calls and messages kept, to be written to a file
+        when a sync fails, 0 for none"""
+        return self.parser.getint('base', 'flight_recorder')
+
+    def incremental(self):
+        """Erase the banks from the tracker up to the newest record
+        stored, so each sync only transfers new data"""
+        return self.parser.getboolean('sync', 'incremental')
+
+    def pipeline(self):
+        """Read from the tracker what the server usually asks for while
+        waiting for its responses"""
+        return self.parser.getboolean('sync', 'pipeline')
+
+    def keepalive(self):
+        """Reuse the connections to the server between requests"""
+        return self.parser.getboolean('http', 'keepalive')
+
+    def timeout(self):
+        """Seconds to wait for the server"""
+        return self.parser.getfloat('http', 'timeout')
+
+    def queue(self):
+        """Keep the syncs the server couldn't get, and upload them
+        later"""
+        return self.parser.getboolean('queue', 'enabled')
+
+    def queue_batch(self):
+        """Queued syncs uploaded between two checks of the server"""
+        return self.parser.getint('queue', 'batch')
+
+    def queue_concurrency(self):
+        """Queued syncs uploaded at the same time"""
+        return self.parser.getint('queue', 'concurrency')
+
+    def min_wait(self):
+        """Seconds between two looks for trackers, at first when none
+        is around"""
+        return self.parser.getfloat('schedule', 'min_wait')
+
+    def max_wait(self):
+        """Seconds between two looks for trackers, at most when none
+        is around"""
+        return self.parser.getfloat('schedule', 'max_wait')
+
+    def metrics_port(self):
+        """Port on localhost serving the metrics to Prometheus, 0 for
+        none"""
+        return self.parser.getint('metrics', 'port')
+
+    def metrics_summary(self):
+        """Append a JSON summary of the metrics of each sync to
+        ~/.fitbit/sync_metrics.json"""
+        return self.parser.getboolean('metrics', 'summary')
+
+    def scan(self):
+        """Look for the trackers in range with the base in scan mode
+        before each sync, instead of waiting for a beacon"""
+        return self.parser.getboolean('discovery', 'scan')
+
+    def scan_time(self):
+        """Seconds each scan listens for"""
+        return self.parser.getfloat('discovery', 'scan_time')
+
+    def retry_policy(self):
+        """How many times each ANT operation is tried. Each one of
+        RetryPolicy.DEFAULTS can be given as 'attempts [deadline=seconds]
+        [backoff=seconds] [factor=2] [max_backoff=seconds] [jitter=0-1]',
+        and usb_timeout is the milliseconds of one USB read."""
+        retries = {}
+        for name in RetryPolicy.DEFAULTS:
+            if self.parser.has_option('retry', name):
+                retries[name] = Retry.parse(self.parser.get('retry', name))
+        return RetryPolicy(retries,
+                           self.parser.getint('retry', 'usb_timeout'))
@@ -43,6 +43,7 @@
 #################################################################
 
 import os, csv, yaml, datetime, itertools
+import bank_decoder, transcript
 
 ENABLE_LOGGING = True
 
@@ -57,6 +58,23 @@ def _read_yaml(yaml_file_path):
     result = yaml.load(raw_data)
     return result
 
+def _read_transcript(transcript_path):
+    """
+    returns only the bank reads of a transcript, found through its index
+    """
+    t = transcript.Transcript(transcript_path)
+    result = list(t.find(0x22))
+    t.close()
+    return result
+
+def _read_dump(file_path):
+    """
+    returns the flat request/response list of a transcript or of a yaml dump
+    """
+    if transcript.is_transcript(file_path):
+        return _read_transcript(file_path)
+    return _get_flat_req_resp_list(_read_yaml(file_path))
+
 def _get_flat_req_resp_list(data):
     if (len(data)>1):
         result = []
@@ -85,74 +103,53 @@ def _filter_by_opcodes(req_resp_list, filter_function):
             
     return result
 
-def _p_0(data):
-    i = 0
-    tstamp = 0
-    result = []
-    while i < len(data):
-        if (data[i] & 0x80) == 0x80:
-            d = data[i:i+3]
-            d0 = d[0] - 0x80 # ???
-            d1 = (d[1] - 10) / 10. # score
-            d2 = d[2] # steps
-            row = {'timestamp':tstamp, 'datetime':datetime.datetime.fromtimestamp(tstamp), '?':d0, 'score':d1, 'steps':d2}
-            _log(row)
-            result.append(row)
-            i += 3
-            tstamp += 60
-            continue
-        d = data[i:i+4]
-        tstamp = d[3] | d[2] << 8 | d[1] << 16 | d[0] << 24
-        if i != 0: _log('---xx--xx--xx--xx')
-        i += 4
-    return result
+def _rows_0(data):
+    batch = bank_decoder.decode_bank0(data)
+    for row in batch.rows(['timestamp', '?', 'score', 'steps']):
+        _log(row)
+        yield row
 
-def _p_1(data):
+def _rows_1(data):
     assert len(data) % 16 == 0
-    result = []
-    for i in xrange(0, len(data), 16):
-        d = data[i:i+16]
-        tstamp = d[0] | d[1] << 8 | d[2] << 16 | d[3] << 24
-        #if date in seen: continue
-        #seen.add(date)
-        date = datetime.datetime.fromtimestamp(tstamp)
+    batch = bank_decoder.decode_bank1(data)
+    for row in batch.rows(['timestamp', 'steps', 'distance', 'floors', 'calories']):
+        date = row['datetime']
         if date.minute == 0 and date.hour == 0 and date.second == 0:
-            #print a2s(d[4:])
-            daily_steps = d[7] << 8 | d[6]
-            daily_dist = (d[11] << 8 | d[10] | d[13] << 24 | d[12] << 16) / 1000000.
-            daily_floors = (d[15] << 8 | d[14]) / 10
-            daily_cals = (d[5] << 8 | d[4]) *.1103 - 7
-            row = {'timestamp':tstamp, 'datetime':date, 'steps': daily_steps, 'distance': daily_dist,'floors':daily_floors, 'calories':daily_cals}
             _log(row)
-            result.append(row)
-            
-    return result
+            yield row
+
+def _rows_6(data):
+    batch = bank_decoder.decode_bank6(data)
+    for row in batch.rows(['timestamp', 'floors']):
+        _log(row)
+        yield row
+
+def _p_0(data):
+    return list(_rows_0(data))
+
+def _p_1(data):
+    return list(_rows_1(data))
 
 def _p_6(data):
-    result = []
-    i = 0
-    tstamp = 0
-    while i < len(data):
-        if data[i] == 0x80:
-            floors = data[i+1] / 10
-            row = {'timestamp':tstamp, 'datetime':datetime.datetime.fromtimestamp(tstamp), 'floors':floors}
-            _log(row)
-            result.append(row)
-            i += 2
-            tstamp += 60
-            continue
-        
-        d = data[i:i+4]
-        tstamp = d[3] | d[2] << 8 | d[1] << 16 | d[0] << 24
-        i += 4
-    return result
+    return list(_rows_6(data))
+
+def _iter_newer(rows, since):
+    if since is None:
+        return rows
+    return (row for row in rows if row['timestamp'] > since)
 
-def convert_for_csv(data):
+def _newer(rows, since):
+    return list(_iter_newer(rows, since))
+
+def convert_for_csv(data, since={}):
     """
     returns a dict with 'minute_activity'-, 'daily_stats' and 'minute_floors'-data  
+    since maps bank indexes to the timestamp of the newest record already written
     """
+    return _convert_req_resp_list(_get_flat_req_resp_list(data), since)
+
+def _convert_req_resp_list(request_response_list, since={}):
     result = {}
-    request_response_list = _get_flat_req_resp_list(data)
     p0 = _filter_by_opcodes(request_response_list, lambda opcode: (opcode[0] == 0x22 and opcode[1] == 0x00) )
     minute_activity = map( _p_0, ( map(lambda e: e['response'], p0) ) ) 
     _log( minute_activity )
@@ -165,9 +162,9 @@ def convert_for_csv(data):
     minute_floors = map( _p_6, ( map(lambda e: e['response'], p6) ) )
     _log( minute_activity )
     
-    result['minute_activity'] = list(itertools.chain.from_iterable(minute_activity))
-    result['daily_stats'] = list(itertools.chain.from_iterable(daily_stats))
-    result['minute_floors'] = list(itertools.chain.from_iterable(minute_floors)) 
+    result['minute_activity'] = _newer(list(itertools.chain.from_iterable(minute_activity)), since.get(0))
+    result['daily_stats'] = _newer(list(itertools.chain.from_iterable(daily_stats)), since.get(1))
+    result['minute_floors'] = _newer(list(itertools.chain.from_iterable(minute_floors)), since.get(6))
     
     return result
 
@@ -186,27 +183,57 @@ def _write_csv_file(directory, filename, header, rows):
     if is_new_csv:
         writer.writeheader()
         
-    writer.writerows(rows)
+    # writerows() would build the list of all the rows first
+    for row in rows:
+        writer.writerow(row)
     f.close()
 
-def write_csv(converted_data, tracker_id, directory='~/.fitbit'):
+# bank index -> (row generator, key in the converted data, csv file, header)
+_BANK_FILES = {0: (_rows_0, 'minute_activity', "minute_activity.csv",
+                   ['timestamp', 'datetime', '?', 'score', 'steps']),
+               6: (_rows_6, 'minute_floors', "minute_floors.csv",
+                   ['timestamp', 'datetime', 'floors']),
+               1: (_rows_1, 'daily_stats', "daily_stats.csv",
+                   ['timestamp', 'datetime', 'steps', 'distance', 'floors', 'calories'])}
+
+def _csv_directory(tracker_id, directory):
     directory = os.path.expanduser(directory)
     directory = os.path.join(directory, tracker_id)
     directory = os.path.join(directory, 'csv')
     if not os.path.isdir(directory):
         os.makedirs(directory)
-        
-    _write_csv_file(directory, "minute_activity.csv", 
-                                 ['timestamp', 'datetime', '?', 'score', 'steps'], converted_data['minute_activity'])
-    
-    _write_csv_file(directory, "minute_floors.csv", 
-               ['timestamp', 'datetime', 'floors'], converted_data['minute_floors'])
-    _write_csv_file(directory, "daily_stats.csv",   
-               ['timestamp', 'datetime', 'steps', 'distance', 'floors', 'calories'], converted_data['daily_stats'] )
-
-def convert_dump_to_csv(yaml_file_path, tracker_id, directory='~/.fitbit'):
-    data = _read_yaml(yaml_file_path)
-    converted = convert_for_csv(data)
+    return directory
+
+def write_csv(converted_data, tracker_id, directory='~/.fitbit'):
+    directory = _csv_directory(tracker_id, directory)
+    for index in (0, 6, 1):
+        rows, key, filename, header = _BANK_FILES[index]
+        _write_csv_file(directory, filename, header, converted_data[key])
+
+def write_transcript_csv(transcript_path, tracker_id, since={}, directory='~/.fitbit'):
+    """
+    writes the bank reads of a transcript one at a time, so that only one bank
+    is ever held in memory
+    since maps bank indexes to the timestamp of the newest record already written
+    """
+    directory = _csv_directory(tracker_id, directory)
+    t = transcript.Transcript(transcript_path)
+    try:
+        for reqresp in t.find(0x22):
+            index = reqresp['request']['opcode'][1]
+            if index not in _BANK_FILES:
+                continue
+            rows, key, filename, header = _BANK_FILES[index]
+            rows = _iter_newer(rows(reqresp['response']), since.get(index))
+            _write_csv_file(directory, filename, header, rows)
+    finally:
+        t.close()
+
+def convert_dump_to_csv(dump_file_path, tracker_id, directory='~/.fitbit'):
+    """
+    dump_file_path is either a transcript or a yaml connection dump
+    """
+    converted = _convert_req_resp_list(_read_dump(dump_file_path))
     write_csv(converted, tracker_id)
 
     
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#################################################################
+# tracker discovery
+# Listens to all the trackers in range at once, with the base in
+# scan mode, and keeps a table of when each was last heard and how
+# strong its signal was.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import time
+from antprotocol.message import EXT_CHANNEL_ID, EXT_RSSI
+from antprotocol.protocol import NoMessageException, StatusException
+from antprotocol.metrics import registry
+
+class Sighting(object):
+    """What was heard of one channel id"""
+
+    def __init__(self, channel_id, now):
+        #: (device number, device type, transmission type)
+        self.channel_id = channel_id
+        self.first_seen = now
+        self.last_seen = now
+        self.beacons = 0
+        #: Signal strength of the last beacon in dBm, None if the base
+        #: doesn't report it
+        self.rssi = None
+
+    def heard(self, rssi, now):
+        self.last_seen = now
+        self.beacons += 1
+        if rssi is not None:
+            self.rssi = rssi
+
+class TrackerDiscovery(object):
+    """Puts base in scan mode, where one channel receives the beacons
+    of all the trackers in range, and keeps a Sighting of each channel
+    id heard. Trackers which haven't been told to hop all beacon with
+    the same channel id (device number 0xffff), so they can only be
+    told apart once paired.
+
+    The base can't do anything else while scanning: start() and stop()
+    are to be called around scan(), before the base is used for a
+    sync.
+
+    """
+
+    #: Channel id received from, device number 0 matching any
+    CHANNEL_ID = [0x00, 0x00, 0x00, 0x00]
+    #: Milliseconds of one USB read while scanning, short for scan() to
+    #: return close to when it is asked to
+    READ_TIMEOUT = 100
+
+    def __init__(self, base, expiry=60, clock=time.time):
+        self.base = base
+        #: Seconds after which a tracker not heard from is forgotten
+        self.expiry = expiry
+        self.clock = clock
+        #: channel id -> Sighting
+        self.trackers = {}
+        self._timeout = None
+
+    def start(self):
+        """Sets our channel of base up and opens it in scan mode"""
+        base = self.base
+        base.reset_channel()
+        base.send_network_key(0, [0,0,0,0,0,0,0,0])
+        base.assign_channel()
+        base.set_channel_frequency(0x2)
+        base.set_transmit_power(0x3)
+        base.set_channel_id(self.CHANNEL_ID)
+        base.enable_extended_messages()
+        try:
+            base.set_lib_config(EXT_CHANNEL_ID | EXT_RSSI)
+        except StatusException:
+            # Older bases only give the channel id, in extended
+            # messages
+            pass
+        base.open_rx_scan_mode()
+        self._timeout = base.connection.timeout
+        base.connection.timeout = min(self._timeout, self.READ_TIMEOUT)
+
+    def stop(self):
+        """Closes the scan, leaving our channel assigned with the data
+        messages back to their usual format"""
+        if self._timeout is not None:
+            self.base.connection.timeout = self._timeout
+            self._timeout = None
+        self.base.close_rx_scan_mode()
+        try:
+            self.base.set_lib_config(0)
+        except StatusException:
+            pass
+        self.base.enable_extended_messages(False)
+
+    def scan(self, seconds):
+        """Listens for seconds, returns the Sightings of the trackers
+        heard meanwhile"""
+        start = self.clock()
+        seen = {}
+        while self.clock() - start < seconds:
+            try:
+                beacon = self.base.receive_scan()
+            except NoMessageException:
+                continue
+            if beacon is None:
+                continue
+            payload, channel_id, rssi = beacon
+            if channel_id is None:
+                continue
+            seen[channel_id] = self.heard(channel_id, rssi)
+        self.expire()
+        registry.set('fitbit_trackers_seen', len(seen))
+        return sorted(seen.values(), key=self._strongest)
+
+    def heard(self, channel_id, rssi):
+        now = self.clock()
+        sighting = self.trackers.get(channel_id)
+        if sighting is None:
+            sighting = self.trackers[channel_id] = Sighting(channel_id, now)
+        sighting.heard(rssi, now)
+        return sighting
+
+    def expire(self):
+        """Forgets the trackers not heard from for expiry seconds"""
+        now = self.clock()
+        for channel_id, sighting in self.trackers.items():
+            if now - sighting.last_seen > self.expiry:
+                del self.trackers[channel_id]
+
+    def present(self, within=None):
+        """Returns the Sightings of the trackers heard in the last
+        within seconds (expiry by default), strongest signal first"""
+        if within is None:
+            within = self.expiry
+        now = self.clock()
+        return sorted([s for s in self.trackers.values()
+                       if now - s.last_seen <= within], key=self._strongest)
+
+    def _strongest(self, sighting):
+        return -sighting.rssi if sighting.rssi is not None else 1000
+
+    def __str__(self):
+        now = self.clock()
+        lines = ["%-6s %4s %5s %8s %7s %6s" % (
+            'device', 'type', 'trans', 'last', 'beacons', 'rssi')]
+        for s in self.present():
+            lines.append("%04x   %4d %5d %7.1fs %7d %6s" % (
+                s.channel_id[0], s.channel_id[1], s.channel_id[2],
+                now - s.last_seen, s.beacons,
+                '%d' % s.rssi if s.rssi is not None else '-'))
+        return '\n'.join(lines)
+
+def main():
+    import sys
+    from antprotocol.connection import getConn
+    from antprotocol.protocol import ANT
+    conn = getConn()
+    if conn is None:
+        sys.exit(1)
+    base = ANT(conn)
+    discovery = TrackerDiscovery(base)
+    discovery.start()
+    try:
+        while True:
+            discovery.scan(1)
+            print
+            print discovery
+    except KeyboardInterrupt:
+        pass
+    finally:
+        discovery.stop()
+        base.close()
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sw=4 expandtab:
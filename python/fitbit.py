@@ -65,8 +65,77 @@
 # - Figuring out more data formats and packets
 # - Implementing data clearing
 
-import itertools, sys, random, operator, datetime, time
+import os, itertools, sys, random, operator, datetime, time, struct
 from antprotocol.protocol import ANTException, ReceiveException, SendException
+from antprotocol.asyncant import AsyncANT
+from antprotocol.metrics import registry
+import bank_decoder
+
+class BankConsumer(object):
+    """Base class for objects decoding a data bank while it is being
+    downloaded. feed() gets every chunk as soon as it arrived, close()
+    is called once the bank is complete.
+
+    """
+
+    def feed(self, data):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class MinuteRecordConsumer(BankConsumer):
+    """Decodes banks made of big endian timestamps, each followed by
+    one record per minute with its MSB set (banks 0 and 6). callback
+    is called with the timestamp and the bytes of every record.
+
+    """
+
+    def __init__(self, size, callback):
+        self.size = size
+        self.callback = callback
+        self._buf = bytearray()
+        self._tstamp = 0
+
+    def feed(self, data):
+        buf = self._buf
+        buf += data
+        i = 0
+        while i < len(buf):
+            if buf[i] & 0x80:
+                if i + self.size > len(buf):
+                    break
+                self.callback(self._tstamp, buf[i:i+self.size])
+                self._tstamp += 60
+                i += self.size
+            else:
+                if i + 4 > len(buf):
+                    break
+                self._tstamp = struct.unpack_from('>I', buf, i)[0]
+                i += 4
+        # Keep the partial record for the next chunk
+        del buf[:i]
+
+class FixedRecordConsumer(BankConsumer):
+    """Decodes banks made of fixed size records starting with a little
+    endian timestamp (banks 1 and 2). callback is called with the
+    timestamp and the bytes of every record.
+
+    """
+
+    def __init__(self, size, callback):
+        self.size = size
+        self.callback = callback
+        self._buf = bytearray()
+
+    def feed(self, data):
+        buf = self._buf
+        buf += data
+        end = len(buf) - len(buf) % self.size
+        for i in range(0, end, self.size):
+            self.callback(struct.unpack_from('<I', buf, i)[0],
+                          buf[i:i+self.size])
+        del buf[:end]
 
 class FitBit(object):
     """Class to represent the fitbit tracker device, the portion of
@@ -151,7 +220,7 @@ class FitBit(object):
 
     def init_device_channel(self, channel):
         # ANT device initialization
-        self.base.reset()
+        self.base.reset_channel()
         self.base.send_network_key(0, [0,0,0,0,0,0,0,0])
         self.base.assign_channel()
         self.base.set_channel_period([0x0, 0x10])
@@ -161,41 +230,71 @@ class FitBit(object):
         self.base.set_channel_id(channel)
         self.base.open_channel()
 
-    def init_tracker_for_transfer(self):
-        self.init_fitbit()
-        self.wait_for_beacon()
-        self.reset_tracker()
-
-        # 0x78 0x02 is device id reset. This tells the device the new
-        # channel id to hop to for dumpage
-        cid = [random.randint(0,254), random.randint(0,254)]
-        self.base.send_acknowledged_data([0x78, 0x02] + cid + [0x00, 0x00, 0x00, 0x00])
+    def hop_device_channel(self, channel):
+        # Only the channel id changes, the rest of the configuration is
+        # kept by the base while the channel is closed
         self.base.close_channel()
-        self.init_device_channel(cid + [0x01, 0x01])
+        self.base.set_channel_id(channel)
+        self.base.open_channel()
+
+    def init_tracker_for_transfer(self, fast_hop=True):
+        """Finds a tracker on the wildcard channel id, then tells it to
+        hop to a random one, and follows it there. With fast_hop, our
+        channel is kept and only its id is changed, instead of being
+        set up again from scratch."""
+        # Until it hops, the tracker answers any channel listening on
+        # the wildcard id
+        with self.base.pairing:
+            with registry.timer('fitbit_phase_seconds', phase='init_fitbit'):
+                self.init_fitbit()
+            self.wait_for_beacon()
+            self.reset_tracker()
+
+            # 0x78 0x02 is device id reset. This tells the device the new
+            # channel id to hop to for dumpage
+            cid = [random.randint(0,254), random.randint(0,254)]
+            self.base.send_acknowledged_data([0x78, 0x02] + cid + [0x00, 0x00, 0x00, 0x00])
+        if fast_hop:
+            self.hop_device_channel(cid + [0x01, 0x01])
+        else:
+            self.base.close_channel()
+            self.init_device_channel(cid + [0x01, 0x01])
         self.wait_for_beacon()
         self.ping_tracker()
 
     def reset_tracker(self):
         # 0x78 0x01 is apparently the device reset command
-        self.base.send_acknowledged_data([0x78, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+        with registry.timer('fitbit_phase_seconds', phase='tracker_reset'):
+            self.base.send_acknowledged_data([0x78, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+
+    #: Seconds the tracker stops beaconing for after command_sleep, its
+    #: last byte counting quarters of a minute
+    SLEEP_TIME = 0x3c * 15
 
     def command_sleep(self):
+        """Tells the tracker to go quiet, returns for how many seconds"""
         self.base.send_acknowledged_data([0x7f, 0x03, 0x00, 0x00, 0x00, 0x00, 0x00, 0x3c])
+        return self.SLEEP_TIME
 
     def wait_for_beacon(self):
-        self.base.receive_bdcast()
+        with registry.timer('fitbit_phase_seconds', phase='beacon_wait'):
+            self.base.receive_bdcast()
 
     def _get_tracker_burst(self):
         d = self.base._check_burst_response()
         if d[1] != 0x81:
-            raise ReceiveException("Response received is not tracker burst! Got %s" % (d[0:2]))
+            raise ReceiveException("Response received is not tracker burst! Got %s" % (list(d[0:2])))
         size = d[3] << 8 | d[2]
-        if size == 0:
-            return []
         return d[8:8+size]
 
-    def run_opcode(self, opcode, payload = []):
-        for tries in range(4):
+    def run_opcode(self, opcode, payload = [], consumer = None):
+        """Runs opcode on the tracker. If a data bank gets returned, it
+        is also fed to consumer while it is downloaded."""
+        with registry.timer('fitbit_opcode_seconds', opcode='%02x' % opcode[0]):
+            return self._run_opcode(opcode, payload, consumer)
+
+    def _run_opcode(self, opcode, payload, consumer):
+        for tries in self.base.retry.attempts('run_opcode'):
             try:
                 self.send_tracker_packet(opcode)
                 data = self.base.receive_acknowledged_reply()
@@ -206,22 +305,22 @@ class FitBit(object):
                 print "Tracker Packet IDs don't match! %02x %02x" % (data[0], self.current_packet_id)
                 continue
             if data[1] == 0x42:
-                return self.get_data_bank()
+                return self.get_data_bank(consumer)
             if data[1] == 0x61:
                 # Send payload data to device
                 if len(payload) > 0:
                     self.send_tracker_payload(payload)
                     data = self.base.receive_acknowledged_reply()
-                    return data[1:]
+                    return list(data[1:])
                 raise SendException("run_opcode: opcode %s, no payload" % (opcode))
             if data[1] == 0x41:
-                return data[1:]
+                return list(data[1:])
         raise ANTException("Failed to run opcode %s" % (opcode))
 
     def send_tracker_payload(self, payload):
         # The first packet will be the packet id, the length of the
         # payload, and ends with the payload checksum
-        p = [0x00, self.gen_packet_id(), 0x80, len(payload), 0x00, 0x00, 0x00, 0x00, reduce(operator.xor, payload)]
+        p = [self.base._chan, self.gen_packet_id(), 0x80, len(payload), 0x00, 0x00, 0x00, 0x00, reduce(operator.xor, payload)]
         prefix = itertools.cycle([0x20, 0x40, 0x60])
         for i in range(0, len(payload), 8):
             current_prefix = prefix.next()
@@ -234,9 +333,7 @@ class FitBit(object):
             while len(plist) < 9:
                 plist += [0x0]
             p += plist
-        # TODO: Sending burst data with a guessed sleep value, should
-        # probably be based on channel timing
-        self.base._send_burst_data(p, .01)
+        self.base._send_burst_data(p)
 
     def get_tracker_info(self):
         data = self.run_opcode([0x24, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
@@ -254,8 +351,8 @@ class FitBit(object):
         self.send_tracker_packet([cmd, 0x00, 0x02, index, 0x00, 0x00, 0x00])
         return self._get_tracker_burst()
 
-    def run_data_bank_opcode(self, index):
-        return self.run_opcode([0x22, index, 0x00, 0x00, 0x00, 0x00, 0x00])
+    def run_data_bank_opcode(self, index, consumer = None):
+        return self.run_opcode([0x22, index, 0x00, 0x00, 0x00, 0x00, 0x00], consumer=consumer)
 
     def erase_data_bank(self, index, tstamp=None):
         if tstamp is None: tstamp = int(time.time())
@@ -266,80 +363,70 @@ class FitBit(object):
                                 (tstamp & 0x000000ff),
                                 0x00])
 
-    def get_data_bank(self):
-        data = []
+    def iter_data_bank(self):
+        """Yields the chunks of the data bank being read, as bytearrays,
+        as soon as they are received."""
         cmd = 0x70  # Send 0x70 on first burst
         for parts in range(2000):
-            bank = self.check_tracker_data_bank(self.current_bank_id, cmd)
+            bank = self.check_tracker_data_bank(self.current_bank_id & 0xff, cmd)
             self.current_bank_id += 1
             cmd = 0x60  # Send 0x60 on subsequent bursts
             if len(bank) == 0:
-                return data
-            data = data + bank
+                return
+            yield bank
         raise ReceiveException("Cannot complete data bank")
 
+    def get_data_bank(self, consumer = None):
+        start = time.time()
+        data = bytearray()
+        for chunk in self.iter_data_bank():
+            data += chunk
+            if consumer is not None:
+                consumer.feed(chunk)
+        if consumer is not None:
+            consumer.close()
+        elapsed = time.time() - start
+        registry.inc('fitbit_bank_bytes_total', len(data))
+        if elapsed > 0:
+            registry.set('fitbit_bank_bytes_per_second', len(data) / elapsed)
+        return list(data)
+
     def parse_bank0_data(self, data):
-        # First 4 bytes are a time
-        i = 0
-        last_date_time = 0
-        time_index = 0
-        while i < len(data):
-            # Date is in bigendian. No, really. And I think it's
-            # because they're prefixing the 3 accelerometer reading
-            # bytes with 0x80, so they can & against it.
-            if not data[i] & 0x80:
-                last_date_time = data[i+3] | data[i+2] << 8 | data[i+1] << 16 | data[i] << 24
-                print "Time: %s" % (datetime.datetime.fromtimestamp(last_date_time))
-                i = i + 4
-                time_index = 0
-            else:
-                record_date = (datetime.datetime.fromtimestamp(last_date_time + 60 * time_index))
-                # steps are easy. It's just the last byte
-                steps = data[i+2]
-                # active score: second byte, subtract 10 (because METs
-                # start at 1 but 1 is subtracted per minute, see
-                # asterisk note on fitbit website, divide by 10.
-                active_score = (data[i+1] - 10) / 10.0
-                # first byte: I don't know. It starts at 0x81. So we at least subtract that.
-                not_sure = data[i] - 0x81
-                print "%s: ???: %d Active Score: %f Steps: %d" % (record_date, not_sure, active_score, steps)
-                i = i + 3
-                time_index = time_index + 1
+        # Date is in bigendian. No, really. And I think it's because
+        # they're prefixing the 3 accelerometer reading bytes with
+        # 0x80, so they can & against it.
+        batch = bank_decoder.decode_bank0(data)
+        headers = {}
+        for index, tstamp in batch.segments:
+            headers.setdefault(index, []).append(tstamp)
+        for i, record_date in enumerate(batch.datetimes() + [None]):
+            for tstamp in headers.get(i, []):
+                print "Time: %s" % (datetime.datetime.fromtimestamp(tstamp))
+            if record_date is None:
+                break
+            # first byte: I don't know. It starts at 0x81. So we at least subtract that.
+            not_sure = batch['?'][i] - 1
+            print "%s: ???: %d Active Score: %f Steps: %d" % (
+                record_date, not_sure, batch['score'][i], batch['steps'][i])
 
     def parse_bank1_data(self, data):
-        ultra = self.hardware_version >= 12
-        banklen = {12:16}.get(self.hardware_version, 14)
-        for i in range(0, len(data), banklen):
-            d = data[i:i+banklen]
-            # First 4 bytes are seconds from Jan 1, 1970
-            maybe_calories = d[5] << 8| d[4]
-            daily_steps = d[9] << 24 | d[8] << 16 | d[7] << 8 | d[6]
-            daily_dist = (d[13] << 24 | d[12] << 16 | d[11] << 8 | d[10]) / 1000000.
-            daily_floors = 0
-            if ultra:
-                daily_floors = (d[15] << 8 | d[14]) / 10
-            record_date = datetime.datetime.fromtimestamp(d[0] | d[1] << 8 | d[2] << 16 | d[3] << 24)
+        batch = bank_decoder.decode_bank1(data, self.hardware_version)
+        for i, record_date in enumerate(batch.datetimes()):
             print "Time: %s %d Daily Steps: %d, Daily distance: %fkm Daily floors: %d" % (
-                record_date, maybe_calories, daily_steps, daily_dist, daily_floors)
+                record_date, batch['calories_raw'][i], batch['steps'][i],
+                batch['distance'][i], batch['floors'][i])
 
     def parse_bank2_data(self, data):
-        ultra = self.hardware_version >= 12
-        banklen = {12:15}.get(self.hardware_version, 13)
-        for i in range(0, len(data), banklen):
-            d = data[i:i+banklen]
-            # First 4 bytes are seconds from Jan 1, 1970
-            print "Time: %s" % (datetime.datetime.fromtimestamp(d[0] | d[1] << 8 | d[2] << 16 | d[3] << 24))
-            if d[6] == 1:
-                elapsed = (d[5] << 8) | d[4]
-                steps = (d[9]<< 16) | (d[8] << 8) | d[7]
-                dist = (d[12] << 16) | (d[11]<< 8) | d[10]
-                floors = 0
-                if ultra:
-                    floors = ((d[14] << 8) | d[13]) / 10
+        batch = bank_decoder.decode_bank2(data, self.hardware_version)
+        size = bank_decoder.bank2_record_size(self.hardware_version)
+        for i, record_date in enumerate(batch.datetimes()):
+            print "Time: %s" % record_date
+            if batch['kind'][i] == 1:
                 print "Activity summary: duration: %s, %d steps, %fkm, %d floors" % (
-                    datetime.timedelta(seconds=elapsed), steps, dist / 100000., floors / 10)
+                    datetime.timedelta(seconds=batch['elapsed'][i]),
+                    batch['steps'][i], batch['distance'][i], batch['floors'][i])
             else:
-                print ' '.join(['%02X' % x for x in d[4:]])
+                print ' '.join(['%02X' % x for x in data[i*size+4:(i+1)*size]])
 
 
     def parse_bank4_data(self, data):
@@ -349,18 +436,9 @@ class FitBit(object):
         print "Chatter: ", ', '.join([''.join([chr(x) for x in data[i:i+8]]) for i in range(34, 64, 10)])
 
     def parse_bank6_data(self, data):
-        i = 0
-        tstamp = 0
-        while i < len(data):
-            if data[i] == 0x80:
-                floors = data[i+1] / 10
-                print "Time: %s: %d Floors" % (datetime.datetime.fromtimestamp(tstamp), floors)
-                i += 2
-                tstamp += 60
-                continue
-            d = data[i:i+4]
-            tstamp = d[3] | d[2] << 8 | d[1] << 16 | d[0] << 24
-            i += 4
+        batch = bank_decoder.decode_bank6(data)
+        for record_date, floors in zip(batch.datetimes(), batch['floors']):
+            print "Time: %s: %d Floors" % (record_date, floors)
 
 
     def write_settings(self, options ,greetings = "", chatter = []):
@@ -374,4 +452,160 @@ class FitBit(object):
     def write_bank(self, index, data):
         self.run_opcode([0x25, index, len(data), 0,0,0,0], data)
 
+class AsyncFitBit(object):
+    """Front end to a FitBit object, running its calls in the worker
+    thread of its base (see antprotocol.asyncant). Every method returns
+    a Future instead of blocking. Consumers are fed from the worker
+    thread.
+
+    """
+
+    def __init__(self, fitbit, worker=None):
+        self.fitbit = fitbit
+        self.base = AsyncANT(fitbit.base, worker)
+
+    def _call(self, name, *args):
+        return self.base.worker.submit(getattr(self.fitbit, name), *args)
+
+    def init_tracker_for_transfer(self, fast_hop=True):
+        return self._call('init_tracker_for_transfer', fast_hop)
+
+    def get_tracker_info(self):
+        return self._call('get_tracker_info')
+
+    def run_opcode(self, opcode, payload = [], consumer = None):
+        return self._call('run_opcode', opcode, payload, consumer)
+
+    def run_data_bank_opcode(self, index, consumer = None):
+        return self._call('run_data_bank_opcode', index, consumer)
+
+    def erase_data_bank(self, index, tstamp=None):
+        return self._call('erase_data_bank', index, tstamp)
+
+    def command_sleep(self):
+        return self._call('command_sleep')
+
+    def close(self):
+        """Closes the base once the pending calls are done"""
+        return self.base.close()
+
+def makes_stale(opcode, read):
+    """Tells if the response to read can have changed once opcode ran.
+    An erase changes its own bank. Written banks are not numbered like
+    the read ones (see doc/fitbit_data.rst), so a write can change any
+    of them."""
+    if opcode[0] == 0x25:
+        return read[0] == 0x22 and read[1] == opcode[1]
+    return opcode[0] == 0x23
+
+class SessionCache(object):
+    """Runs opcodes ahead of time during one sync, through an
+    AsyncFitBit, and hands their results over when they are asked for.
+    Has the run_opcode() of a FitBit, so that the requests of the
+    server can go through it.
+
+    """
+
+    #: What the server asks for on every sync: the tracker info, then
+    #: reads of banks 5, 4, 2, 0 and 1 (see doc/fitbit_protocol.asciidoc)
+    USUAL_OPCODES = [[0x24, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]] + \
+                    [[0x22, index, 0x00, 0x00, 0x00, 0x00, 0x00]
+                     for index in (5, 4, 2, 0, 1)]
+
+    def __init__(self, device):
+        self.device = device
+        #: opcode -> Future of its response
+        self._pending = {}
+        #: opcodes already run, not to be prefetched again
+        self._seen = set()
+
+    def prefetch(self, opcodes = None):
+        """Queues the opcodes which haven't been run yet. Only reads are
+        safe to run ahead of time."""
+        if opcodes is None:
+            opcodes = self.USUAL_OPCODES
+        for opcode in opcodes:
+            key = tuple(opcode)
+            if key in self._seen or opcode[0] not in (0x22, 0x24):
+                continue
+            self._seen.add(key)
+            self._pending[key] = self.device.run_opcode(opcode)
+
+    def invalidate(self, opcode):
+        """Drops the prefetched reads opcode makes stale"""
+        for key in self._pending.keys():
+            if makes_stale(opcode, key):
+                del self._pending[key]
+
+    def run_opcode(self, opcode, payload = [], consumer = None):
+        key = tuple(opcode)
+        self._seen.add(key)
+        future = self._pending.pop(key, None)
+        if future is not None and consumer is None and \
+           future.exception() is None:
+            return future.result()
+        # Reads done before this one may be stale
+        self.invalidate(opcode)
+        return self.device.run_opcode(opcode, payload, consumer).result()
+
+class OpcodeCache(object):
+    """Remembers the responses to the reads run during one sync, as
+    the server may ask for the same ones again in later requests. Has
+    the run_opcode() of a FitBit, and runs the other opcodes on the
+    tracker given.
+
+    """
+
+    #: Opcodes returning the same response until something is erased
+    #: or written: bank reads and the tracker info
+    READS = (0x22, 0x24)
+
+    def __init__(self, tracker, spill = None):
+        self.tracker = tracker
+        #: (opcode, payload) -> response, or (offset, length) in spill
+        self._responses = {}
+        #: File the responses are kept in instead of memory
+        self.spill = spill
+        self.hits = 0
+        self.misses = 0
+        #: bytes of responses which didn't go over the air again
+        self.saved_bytes = 0
+
+    def invalidate(self, opcode):
+        """Forgets the reads opcode makes stale"""
+        for key in self._responses.keys():
+            if makes_stale(opcode, key[0]):
+                del self._responses[key]
+
+    def run_opcode(self, opcode, payload = [], consumer = None):
+        key = (tuple(opcode), tuple(payload or []))
+        if opcode[0] not in self.READS:
+            self.invalidate(opcode)
+            return self.tracker.run_opcode(opcode, payload, consumer)
+        response = self._responses.get(key)
+        if response is not None and self.spill is not None:
+            offset, length = response
+            self.spill.seek(offset)
+            response = bytearray(self.spill.read(length))
+        if response is not None:
+            self.hits += 1
+            self.saved_bytes += len(response)
+            if consumer is not None:
+                consumer.feed(bytearray(response))
+                consumer.close()
+            return list(response)
+        self.misses += 1
+        response = self.tracker.run_opcode(opcode, payload, consumer)
+        if self.spill is not None:
+            self.spill.seek(0, os.SEEK_END)
+            self._responses[key] = (self.spill.tell(), len(response))
+            self.spill.write(str(bytearray(response)))
+        else:
+            self._responses[key] = list(response)
+        return response
+
+    def __str__(self):
+        return "%d hits, %d misses, %d bytes saved" % (
+            self.hits, self.misses, self.saved_bytes)
+
 # vim: set ts=4 sw=4 expandtab:
@@ -0,0 +1,576 @@
+#!/usr/bin/env python
+#################################################################
+# sync benchmark
+# Times the radio side of a sync against the simulated base, so
+# that sync latency can be measured without hardware.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import time
+import base64
+import shutil
+import tempfile
+import random
+import threading
+import argparse
+import BaseHTTPServer
+import SocketServer
+from antprotocol.connection import SimulatedFitBitANT, SimulatedTracker, \
+     make_fixture_banks, RecordingConnection, ReplayConnection, \
+     FaultyConnection
+from antprotocol.protocol import ANT, ANTSession, ANTException, \
+     NoMessageException, FitBitBeaconTimeout
+from antprotocol.retry import Retry, RetryPolicy
+from antprotocol.message import MessageOUT, FrameDecoder
+from antprotocol.asyncant import wait, Worker
+from scheduler import SyncScheduler
+from discovery import TrackerDiscovery
+from fitbit import FitBit, AsyncFitBit, SessionCache, OpcodeCache, \
+     MinuteRecordConsumer, FixedRecordConsumer
+
+def radio_sync(tracker, timings, fast_hop=True):
+    """Runs the opcodes of a usual sync, recording the time spent in
+    each phase into timings."""
+    def phase(name, f, *args):
+        start = time.time()
+        res = f(*args)
+        timings.setdefault(name, []).append(time.time() - start)
+        return res
+
+    records = []
+    def count(tstamp, record):
+        records.append(tstamp)
+    # Banks are decoded while they are downloaded
+    consumers = {0: MinuteRecordConsumer(3, count),
+                 1: FixedRecordConsumer(16, count),
+                 2: FixedRecordConsumer(15, count),
+                 6: MinuteRecordConsumer(2, count)}
+
+    phase('init_tracker_for_transfer', tracker.init_tracker_for_transfer,
+          fast_hop)
+    phase('get_tracker_info', tracker.get_tracker_info)
+    for index in (0, 1, 2, 6):
+        phase('read bank%d' % index, tracker.run_data_bank_opcode, index,
+              consumers[index])
+    # Settings as sent by the server, as a burst of 8 packets
+    payload = range(64)
+    phase('write bank4', tracker.run_opcode,
+          [0x23, 0x04, len(payload), 0, 0, 0, 0], payload)
+    phase('command_sleep', tracker.command_sleep)
+    return len(records)
+
+def concurrent_sync(conn, count, timings):
+    """Syncs count trackers at the same time on one session, returns
+    the amount of records read from each of them."""
+    session = ANTSession(conn, channels=count)
+    session.start()
+    records = []
+    def sync(channel):
+        device = FitBit(channel)
+        records.append(radio_sync(device, {}))
+        channel.close()
+    threads = [threading.Thread(target=sync, args=(session.channel(),))
+               for i in range(count)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    timings.setdefault('concurrent syncs', []).append(time.time() - start)
+    session.close()
+    return records
+
+def web_sync(tracker, latency, pipeline):
+    """Runs the request chain of the server, each upload taking
+    latency seconds, the way FitBitClient does. Returns the time it
+    took, and the OpcodeCache used."""
+    info = [0x24, 0, 0, 0, 0, 0, 0]
+    reads = [[0x22, index, 0, 0, 0, 0, 0] for index in (5, 4, 2, 0, 1)]
+    erases = [[0x25, index, 0x7f, 0xff, 0xff, 0xff, 0] for index in (0, 1)]
+    # The info and the reads of the banks not erased are asked again
+    chain = [[], [info], reads, erases, [info] + reads[:3], []]
+    start = time.time()
+    tracker.init_tracker_for_transfer()
+    target = tracker
+    if pipeline:
+        worker = Worker()
+        target = prefetcher = SessionCache(AsyncFitBit(tracker, worker))
+    cache = OpcodeCache(target)
+    for opcodes in chain:
+        for opcode in opcodes:
+            cache.run_opcode(opcode)
+        if pipeline:
+            prefetcher.prefetch()
+        # Upload of the responses, and wait for the next opcodes
+        time.sleep(latency)
+    if pipeline:
+        worker.close()
+    tracker.command_sleep()
+    return time.time() - start, cache
+
+def async_syncs(bases, minutes, time_scale):
+    """Syncs one simulated tracker on each of several bases from this
+    thread, through AsyncFitBit. Returns the amount of records read from
+    each of them."""
+    devices = []
+    for i in range(bases):
+        tracker = SimulatedTracker(make_fixture_banks(minutes=minutes),
+                                   time_scale=time_scale)
+        conn = SimulatedFitBitANT([tracker], time_scale)
+        conn.open()
+        devices.append(AsyncFitBit(FitBit(ANT(conn))))
+    records = [[] for device in devices]
+    pending = []
+    for device, found in zip(devices, records):
+        def count(tstamp, record, found=found):
+            found.append(tstamp)
+        # Calls on a base run in order, no need to wait between them
+        device.init_tracker_for_transfer()
+        device.get_tracker_info()
+        device.run_data_bank_opcode(0, MinuteRecordConsumer(3, count))
+        device.run_data_bank_opcode(1, FixedRecordConsumer(16, count))
+        device.run_data_bank_opcode(2, FixedRecordConsumer(15, count))
+        device.run_data_bank_opcode(6, MinuteRecordConsumer(2, count))
+        pending.append(device.command_sleep())
+    wait(pending)
+    wait([device.close() for device in devices])
+    return [len(found) for found in records]
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the fitbit server, answering every upload with
+    the next request of a chain of count, taking handshake seconds to
+    accept each new connection. opcodes[step] are the opcodes sent with
+    each request. Answers 503 while up is False."""
+
+    daemon_threads = True
+
+    def __init__(self, count, handshake, opcodes=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StandInHandler)
+        self.count = count
+        self.handshake = handshake
+        self.opcodes = opcodes or {}
+        self.up = True
+        #: requests answered while up
+        self.uploads = 0
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response at once, not header by header
+    wbufsize = -1
+
+    def setup(self):
+        time.sleep(self.server.handshake)
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        if not self.server.up:
+            self.send_error(503)
+            return
+        self.server.uploads += 1
+        step = int(self.path.split('/')[-1])
+        body = '<?xml version="1.0" ?><fitbitClient version="1.0">'
+        if step < self.server.count:
+            body += '<response host="127.0.0.1:%d" path="/step/%d">' \
+                    'step=%d</response>' % (self.server.server_port,
+                                            step + 1, step)
+            body += '<device><remoteOps>'
+            for opcode in self.server.opcodes.get(step, []):
+                body += '<remoteOp><opCode>%s</opCode><payloadData>' \
+                        '</payloadData></remoteOp>' % base64.b64encode(
+                    ''.join(chr(x) for x in opcode))
+            body += '</remoteOps></device>'
+        body += '</fitbitClient>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def http_chain(count, handshake, keepalive):
+    """Runs a request chain of count uploads against a stand-in server,
+    returns the time it took and the pool used, if any."""
+    from fitbit_client import FitBitRequest
+    from http_pool import ConnectionPool
+    server = StandInServer(count, handshake)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    pool = ConnectionPool() if keepalive else None
+    conn = FitBitRequest('127.0.0.1:%d' % server.server_port, '/step/0',
+                         pool=pool)
+    start = time.time()
+    while conn is not None:
+        conn.upload({'beaconType': 'standard'})
+        conn = conn.getNext()
+    elapsed = time.time() - start
+    if pool is not None:
+        pool.close()
+    server.shutdown()
+    server.server_close()
+    return elapsed, pool
+
+def offline_syncs(syncs, minutes):
+    """Runs syncs through FitBitClient while the stand-in server is
+    down, then brings it up and drains the upload queue. Returns the
+    time spent in the radio syncs and in the drain."""
+    import fitbit_client
+    from upload_queue import UploadQueue
+    # The usual chain: info, then bank reads
+    server = StandInServer(2, 0, {0: [[0x24, 0, 0, 0, 0, 0, 0]],
+                                  1: [[0x22, index, 0, 0, 0, 0, 0]
+                                      for index in (5, 4, 2, 0, 1)]})
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = fitbit_client.FitBitClient
+    client.FITBIT_HOST = '127.0.0.1:%d' % server.server_port
+    client.FITBIT_HTTPS = False
+    client.START_PATH = '/step/0'
+    directory = tempfile.mkdtemp()
+    daemon = fitbit_client.FitBitDaemon(False)
+    daemon.queue = UploadQueue(directory)
+    server.up = False
+    start = time.time()
+    for i in range(syncs):
+        tracker = SimulatedTracker(make_fixture_banks(minutes=minutes))
+        conn = SimulatedFitBitANT([tracker])
+        conn.open()
+        daemon.base = ANT(conn)
+        daemon.start_drain()
+        daemon.do_sync()
+        daemon.close_base()
+    radio = time.time() - start
+    queued = len(daemon.queue)
+    if daemon.drainer is not None:
+        daemon.drainer.join()
+    server.up = True
+    start = time.time()
+    daemon.start_drain()
+    daemon.drainer.join()
+    drain = time.time() - start
+    print "%d syncs queued while the server was down, %d left after " \
+          "draining, %d uploads" % (queued, len(daemon.queue), server.uploads)
+    shutil.rmtree(directory)
+    server.shutdown()
+    server.server_close()
+    return radio, drain
+
+def daemon_day(days, scheduled, sync_time=10., listen_time=60.):
+    """Simulates the loop of FitBitDaemon over days, with a tracker in
+    range of the base from 7:00 to 23:00, which syncs in sync_time
+    seconds and goes to sleep afterwards. Looking for a tracker which
+    isn't there takes listen_time seconds (60 receive timeouts).
+    Returns the seconds spent listening in vain, the amount of syncs,
+    and the mean delay between the tracker waking up and its sync."""
+    clock = [0.]
+    scheduler = SyncScheduler(clock=lambda: clock[0])
+    awake_at = 0.
+    listening = 0.
+    delays = []
+    while clock[0] < days * 86400:
+        now = clock[0]
+        if 7 * 3600 <= now % 86400 < 23 * 3600 and now >= awake_at:
+            delays.append(now - max(awake_at, now - now % 86400 + 7 * 3600))
+            clock[0] += sync_time
+            awake_at = clock[0] + FitBit.SLEEP_TIME
+            scheduler.synced('tracker', FitBit.SLEEP_TIME)
+        else:
+            clock[0] += listen_time
+            listening += listen_time
+            scheduler.missed()
+        if scheduled:
+            clock[0] += scheduler.next_wait()
+        else:
+            clock[0] += 3
+    return listening, len(delays), sum(delays) / len(delays)
+
+def discover(count, time_scale, scan_time=2.):
+    """Times finding out which of count trackers are in range, with a
+    scan of scan_time seconds and by waiting for a beacon, first with
+    half of them in range, then with none. Returns a list of (what,
+    trackers found, seconds at the speed of the real hardware)."""
+    trackers = []
+    for i in range(count):
+        tracker = SimulatedTracker(time_scale=time_scale)
+        if i:
+            # Only one tracker answers the wildcard id, the others
+            # are busy syncing on the id they hopped to
+            tracker.channel_id = [i, 0x00, 0x01, 0x01]
+        tracker.rssi = random.randint(-90, -40)
+        tracker.in_range = i % 2 == 0
+        trackers.append(tracker)
+    conn = SimulatedFitBitANT(trackers, time_scale)
+    conn.open()
+    base = ANT(conn)
+    base.reset()
+    results = []
+    for present in (True, False):
+        if not present:
+            for tracker in trackers:
+                tracker.in_range = False
+        discovery = TrackerDiscovery(base)
+        start = time.time()
+        discovery.start()
+        seen = discovery.scan(scan_time * time_scale)
+        discovery.stop()
+        results.append(('scan', len(seen), (time.time() - start) / time_scale))
+        device = FitBit(base)
+        start = time.time()
+        found = 1
+        try:
+            device.init_fitbit()
+            device.wait_for_beacon()
+        except FitBitBeaconTimeout:
+            found = 0
+        results.append(('beacon wait', found, (time.time() - start) / time_scale))
+    base.close()
+    return results
+
+def replay(path, realtime):
+    """Decodes all the frames received in a capture file, and returns
+    the amount of messages and the time it took."""
+    conn = ReplayConnection(path, realtime)
+    conn.open()
+    base = ANT(conn)
+    count = 0
+    start = time.time()
+    while True:
+        try:
+            base._receive_message()
+        except NoMessageException:
+            break
+        count += 1
+    return count, time.time() - start
+
+def corrupted_stream(count, noise):
+    """Builds a stream of count burst messages, a fraction noise of
+    them being corrupted or preceded by garbage."""
+    rnd = random.Random(count)
+    stream = bytearray()
+    for i in range(count):
+        frame = MessageOUT(0x50, (i % 3 + 1) << 5,
+                           [rnd.randint(0, 255) for j in range(8)]).raw
+        if rnd.random() < noise:
+            if rnd.random() < 0.5:
+                frame[rnd.randint(1, len(frame) - 1)] ^= 0xff
+            else:
+                stream += bytearray([rnd.randint(0, 255)
+                                     for j in range(rnd.randint(1, 32))])
+        stream += frame
+    return stream
+
+def framing(count, noise, chunk=4096):
+    """Times the decoding of a corrupted stream, read chunk bytes at a
+    time as from the base."""
+    stream = corrupted_stream(count, noise)
+    decoder = FrameDecoder()
+    decoded = 0
+    start = time.time()
+    for i in range(0, len(stream), chunk):
+        decoder.feed(buffer(stream, i, chunk))
+        for msg in decoder:
+            decoded += 1
+    elapsed = time.time() - start
+    print "noise %5.1f%%: %7d bytes, %6d/%d messages in %.4fs " \
+          "(%.0f kB/s), %d bytes discarded" % (
+        noise * 100, len(stream), decoded, count, elapsed,
+        len(stream) / elapsed / 1000, decoder.discarded)
+
+def report(timings):
+    print "%-28s %10s %10s %10s" % ('phase', 'min', 'avg', 'max')
+    for name in sorted(timings.keys()):
+        t = timings[name]
+        print "%-28s %9.4fs %9.4fs %9.4fs" % (name, min(t),
+                                              sum(t) / len(t), max(t))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--syncs", help="Number of syncs to run", type=int, default=5)
+    parser.add_argument("--minutes", help="Minutes of data held by the tracker", type=int, default=24*60)
+    parser.add_argument("--time-scale", help="Simulated timings, 1.0 is real hardware speed", type=float, default=0.0)
+    parser.add_argument("--readahead", help="Read from the base in a background thread", action="store_true")
+    parser.add_argument("--record", help="Capture the traffic of the last sync to this file")
+    parser.add_argument("--replay", help="Time the decoding of the frames of a capture file")
+    parser.add_argument("--realtime", help="Replay frames at the speed they were captured", action="store_true")
+    parser.add_argument("--framing", help="Time the decoding of this many messages from corrupted streams", type=int)
+    parser.add_argument("--trackers", help="Sync this many trackers at the same time", type=int, default=1)
+    parser.add_argument("--persistent", help="Keep the base open between syncs", action="store_true")
+    parser.add_argument("--full-hop", help="Set the channel up again from scratch after the tracker hops", action="store_true")
+    parser.add_argument("--bases", help="Sync one tracker on each of this many bases, from one thread", type=int, default=1)
+    parser.add_argument("--upload-latency", help="Run the request chain of the server, each upload taking this many seconds", type=float)
+    parser.add_argument("--pipeline", help="Read from the tracker while uploading", action="store_true")
+    parser.add_argument("--http", help="Time a chain of this many uploads to a local stand-in server", type=int)
+    parser.add_argument("--handshake", help="Seconds the stand-in server takes to accept a connection", type=float, default=0.1)
+    parser.add_argument("--keepalive", help="Reuse connections to the stand-in server", action="store_true")
+    parser.add_argument("--offline", help="Sync while the stand-in server is down, then upload the queued syncs", action="store_true")
+    parser.add_argument("--schedule", help="Simulate this many days of the daemon loop, with and without its scheduler", type=int)
+    parser.add_argument("--retry", help="Retry limits of an operation, as in 'acknowledged_data=8 backoff=0.01'", action="append", default=[])
+    parser.add_argument("--usb-timeout", help="Milliseconds of one USB read", type=int)
+    parser.add_argument("--discover", help="Time finding which of this many trackers are in range, by scanning and by waiting for a beacon", type=int)
+    parser.add_argument("--faults", help="Faults injected in the traffic with the base, as in 'drop=0.01 corrupt=0.005 seed=1'")
+    args = parser.parse_args()
+
+    retries = {}
+    for spec in args.retry:
+        name, text = spec.split('=', 1)
+        retries[name.strip()] = Retry.parse(text)
+    policy = RetryPolicy(retries, args.usb_timeout)
+
+    if args.framing:
+        for noise in (0.0, 0.01, 0.1, 0.5):
+            framing(args.framing, noise)
+        return
+
+    if args.replay:
+        count, elapsed = replay(args.replay, args.realtime)
+        print "%d messages decoded in %.4fs" % (count, elapsed)
+        return
+
+    if args.schedule:
+        for name, scheduled, listen_time in (
+            ('every 3 seconds', False, 60.),
+            ('scheduled', True, 60.),
+            ('scheduled, scans', True, 2.)):
+            listening, syncs, delay = daemon_day(args.schedule, scheduled,
+                                                 listen_time=listen_time)
+            print "%-16s %6d syncs, %7.0fs listening for no tracker, " \
+                  "synced %.1fs after waking up" % (
+                name, syncs, listening, delay)
+        return
+
+    if args.discover:
+        # Beacons only come at their own pace, not as fast as possible
+        time_scale = args.time_scale or 0.01
+        results = discover(args.discover, time_scale)
+        print
+        for what, found, elapsed in results:
+            print "%-12s %3d trackers found in %6.1fs" % (what, found, elapsed)
+        return
+
+    timings = {}
+    if args.offline:
+        radio, drain = offline_syncs(args.syncs, args.minutes)
+        timings['radio syncs'] = [radio]
+        timings['queue drain'] = [drain]
+        report(timings)
+        return
+
+    if args.http:
+        for i in range(args.syncs):
+            elapsed, pool = http_chain(args.http, args.handshake,
+                                       args.keepalive)
+            timings.setdefault('upload chain', []).append(elapsed)
+        print
+        if pool is not None:
+            print "HTTP:", pool
+        report(timings)
+        return
+
+    if args.upload_latency is not None:
+        for i in range(args.syncs):
+            tracker = SimulatedTracker(make_fixture_banks(minutes=args.minutes),
+                                       time_scale=args.time_scale)
+            conn = SimulatedFitBitANT([tracker], args.time_scale)
+            conn.open()
+            base = ANT(conn)
+            name = 'pipelined sync' if args.pipeline else 'serial sync'
+            elapsed, cache = web_sync(FitBit(base), args.upload_latency,
+                                      args.pipeline)
+            timings.setdefault(name, []).append(elapsed)
+            base.close()
+        print
+        print "Opcode cache:", cache
+        report(timings)
+        return
+
+    if args.bases > 1:
+        for i in range(args.syncs):
+            start = time.time()
+            records = async_syncs(args.bases, args.minutes, args.time_scale)
+            timings.setdefault('syncs on all bases', []).append(time.time() - start)
+        print
+        print "%d bases synced, %s records decoded" % (len(records), records)
+        report(timings)
+        return
+
+    if args.trackers > 1:
+        for i in range(args.syncs):
+            trackers = [SimulatedTracker(make_fixture_banks(minutes=args.minutes),
+                                         time_scale=args.time_scale)
+                        for j in range(args.trackers)]
+            conn = SimulatedFitBitANT(trackers, args.time_scale)
+            conn.open()
+            records = concurrent_sync(conn, args.trackers, timings)
+        print
+        print "%d trackers synced, %s records decoded" % (len(records), records)
+        report(timings)
+        return
+
+    base = None
+    faulty = None
+    # Commands sent to the base during each sync
+    sent = []
+    failures = 0
+    records = 0
+    for i in range(args.syncs):
+        tracker = SimulatedTracker(make_fixture_banks(minutes=args.minutes),
+                                   time_scale=args.time_scale)
+        start = time.time()
+        if base is None:
+            conn = simulator = SimulatedFitBitANT([tracker], args.time_scale)
+            if faulty is not None:
+                # Keep counting, and drawing the faults, from where the
+                # last base left off
+                faulty.connection = conn
+                conn = faulty
+            elif args.faults:
+                conn = faulty = FaultyConnection.parse(conn, args.faults)
+            if args.record and i == args.syncs - 1:
+                conn = RecordingConnection(conn, args.record)
+            conn.open()
+            base = ANT(conn, readahead=args.readahead)
+            base.set_retry_policy(policy)
+        else:
+            # A new tracker comes in range of the base left open
+            simulator.trackers = [tracker]
+        device = FitBit(base)
+        commands = simulator.commands
+        try:
+            records = radio_sync(device, timings, not args.full_hop)
+        except ANTException, e:
+            print "Sync failed: %s %s" % (e.__class__.__name__, e)
+            failures += 1
+            # Start over with the base, as the daemon does
+            base.close()
+            base = None
+            continue
+        timings.setdefault('total', []).append(time.time() - start)
+        sent.append(simulator.commands - commands)
+        if not args.persistent:
+            base.close()
+            base = None
+    if base is not None:
+        base.close()
+    print
+    print "%d records decoded per sync" % records
+    if sent:
+        print "%d to %d commands sent to the base per sync" % (min(sent), max(sent))
+    if faulty is not None:
+        print "%d of %d syncs failed, %s" % (failures, args.syncs, faulty)
+    print
+    print policy
+    print
+    report(timings)
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sw=4 expandtab:
@@ -46,23 +46,41 @@
 
 import os
 import time
-import yaml
 import sys
+import resource
+import tempfile
+import socket
+import httplib
 import urllib
 import urllib2
 import urlparse
 import base64
 import argparse
+import threading
 import xml.etree.ElementTree as et
-from fitbit import FitBit
-import csv_writer, client_config
+from fitbit import FitBit, AsyncFitBit, SessionCache, OpcodeCache
+import csv_writer, client_config, transcript
+from http_pool import ConnectionPool
+from upload_queue import UploadQueue, StoredTracker, uplink_failure
+from sync_state import SyncState, NewestRecords
+from scheduler import SyncScheduler
+from discovery import TrackerDiscovery
 from antprotocol.connection import getConn
-from antprotocol.protocol import ANT, ANTException, FitBitBeaconTimeout
+from antprotocol.asyncant import Worker
+from antprotocol.metrics import registry
+from antprotocol.tracing import FlightRecorder, MultiTracer
+from metrics_exporter import MetricsServer, write_summary
+from antprotocol.protocol import ANT, ANTSession, ANTException, \
+     FitBitBeaconTimeout
 
 class FitBitRequest(object):
 
-    def __init__(self, host, path, https = False, response = None, opcodes = []):
+    def __init__(self, host, path, https = False, response = None, opcodes = [], pool = None, timeout = 30):
         self.current_opcode = {}
+        #: ConnectionPool to upload through, urlopen() is used otherwise
+        self.pool = pool
+        #: Seconds to wait for the server without a pool
+        self.timeout = timeout
         self.opcodes = opcodes
         self.response = response
         self.host = host
@@ -75,8 +93,12 @@ class FitBitRequest(object):
 
     def upload(self, params):
         data = urllib.urlencode(params)
-        req = urllib2.urlopen(self.url, data)
-        self.rawresponse = req.read()
+        with registry.timer('fitbit_http_seconds'):
+            if self.pool is not None:
+                self.rawresponse = self.pool.post(self.url, data)
+                return
+            req = urllib2.urlopen(self.url, data, self.timeout)
+            self.rawresponse = req.read()
 
     def getNext(self):
         root = et.fromstring(self.rawresponse.strip())
@@ -95,7 +117,8 @@ class FitBitRequest(object):
         for remoteop in root.findall("device/remoteOps/remoteOp"):
             opcodes.append(RemoteOp(remoteop))
 
-        return FitBitRequest(host, path, response=response, opcodes=opcodes)
+        return FitBitRequest(host, path, response=response, opcodes=opcodes,
+                             pool=self.pool, timeout=self.timeout)
 
     def run_opcodes(self, fitbit):
         res = {}
@@ -147,21 +170,65 @@ class RemoteOp(object):
                 'status': self.status,
                 'response': self.rawresponse}
 
+#: What goes wrong when the server can't be reached
+UPLINK_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+def reset_peak_memory():
+    """Starts a new high water mark of the resident memory, where the
+    system allows it (Linux 4.0 and later)"""
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        f.write('5')
+        f.close()
+    except IOError:
+        pass
+
+def peak_memory():
+    """Returns the high water mark of the resident memory, in kB"""
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    # Since the start of the process, in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
 class FitBitClient(object):
     CLIENT_UUID = "2ea32002-a079-48f4-8020-0badd22939e3"
     FITBIT_HOST = "client.fitbit.com"
+    FITBIT_HTTPS = True
     START_PATH = "/device/tracker/uploadData"
+    #: Set by close(), which __del__ calls again
+    closed = False
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, base=None, queue=None):
+        #: UploadQueue keeping the syncs which couldn't be uploaded
+        self.queue = queue
         self.info_dict = {}
         self.log_info = {}
         self.time = time.time()
         self.data = []
-        conn = getConn()
-        if conn is None:
-            print "No base found!"
-            exit(1)
-        base = ANT(conn)
+        #: high water marks of the banks before this sync
+        self.previous_marks = {}
+        self.config = client_config.ClientConfig()
+        #: In streaming mode, the requests only go to the transcript,
+        #: and self.data stays empty
+        self.streaming = self.config.streaming()
+        #: TranscriptWriter of the sync
+        self.transcript = None
+        self.newest_records = NewestRecords()
+        #: Seconds the tracker was told to sleep for once synced
+        self.sleep_time = None
+        #: A base given by the caller is left open by close()
+        self.owns_base = base is None
+        if base is None:
+            conn = getConn()
+            if conn is None:
+                print "No base found!"
+                exit(1)
+            base = ANT(conn, readahead=self.config.readahead())
+            base.set_retry_policy(self.config.retry_policy())
         self.fitbit = FitBit(base)
         if not self.fitbit:
             print "No devices connected!"
@@ -185,70 +252,311 @@ class FitBitClient(object):
                 self.log_info[f] = self.info_dict[f]
                
 
-    def dump_connection(self, directory='~/.fitbit'):
-        directory = os.path.expanduser(directory)
-        output_file = os.path.join(directory,'connection-%d.txt' % int(self.time))
-        data = yaml.dump(self.data)
-        if 'userPublicId' in self.log_info:            
+    def open_transcript(self, directory='~/.fitbit'):
+        """Starts the transcript the requests are appended to, as they
+        are done. Without dump_connection, it only lives for the sync."""
+        if self.config.dump_connection():
+            directory = os.path.expanduser(directory)
             if not os.path.isdir(directory):
                 os.makedirs(directory)
-            f = open(output_file, 'w')
-            f.write(data)
-            f.close()
-        print data
+            # Concurrent syncs start within the same second, each needs
+            # a file of its own
+            fd, output_file = tempfile.mkstemp(
+                prefix='connection-%d-' % int(self.time), suffix='.fbt',
+                dir=directory)
+            os.close(fd)
+        else:
+            fd, output_file = tempfile.mkstemp(suffix='.fbt')
+            os.close(fd)
+        self.transcript = transcript.TranscriptWriter(output_file)
+
+    def dump_connection(self):
+        """Ends the transcript of the sync, returns its path"""
+        if self.transcript is None:
+            return None
+        output_file = self.transcript.path
+        self.transcript.close()
+        self.transcript = None
         return output_file
     
-    def write_csv(self):
+    def write_csv(self, transcript_path=None):
         import traceback
         try:
             if 'userPublicId' in self.log_info:
-                csv_writer.write_csv( csv_writer.convert_for_csv(self.data), self.log_info['userPublicId'] )
+                if self.streaming and transcript_path is not None:
+                    csv_writer.write_transcript_csv(transcript_path, self.log_info['userPublicId'], self.previous_marks)
+                else:
+                    csv_writer.write_csv( csv_writer.convert_for_csv(self.data, self.previous_marks), self.log_info['userPublicId'] )
         except Exception:
             print "Could not write csv files."
             traceback.print_exc(file=sys.stdout)
 
     def close(self):
-        cfg = client_config.ClientConfig()
-        if cfg.dump_connection():
-            self.dump_connection()
+        if self.closed:
+            return
+        self.closed = True
+        cfg = self.config
+        output_file = self.dump_connection()
         if cfg.write_csv():
-            self.write_csv()
-            
-        print 'Closing USB device'
-        try:
-            self.fitbit.base.connection.close()
-        except AttributeError:
-            pass
+            self.write_csv(output_file)
+        if output_file is not None:
+            # Only kept if the server told us who the tracker belongs to
+            if cfg.dump_connection() and 'userPublicId' in self.log_info:
+                print "Connection dumped to", output_file
+            else:
+                os.remove(output_file)
+
+        if self.owns_base:
+            print 'Closing USB device'
+            try:
+                self.fitbit.base.close()
+            except AttributeError:
+                pass
         self.fitbit.base = None
 
     def run_upload_requests(self):
         self.fitbit.init_tracker_for_transfer()
 
-        conn = FitBitRequest(self.FITBIT_HOST, self.START_PATH, https=True)
+        if self.queue is not None and self.queue.offline:
+            self.store_for_upload()
+            self.sleep_time = self.fitbit.command_sleep()
+            return
+
+        worker = None
+        tracker = self.fitbit
+        if self.config.pipeline():
+            # The usual reads run while we wait for the server, which
+            # gets them from the cache once it asks for them
+            worker = Worker()
+            tracker = SessionCache(AsyncFitBit(self.fitbit, worker))
+        try:
+            self.run_request_chain(tracker)
+            if self.queue is not None:
+                self.queue.set_offline(False)
+        except UPLINK_ERRORS, e:
+            if self.queue is None or not uplink_failure(e):
+                raise
+            print "Server unreachable (%s), keeping the data for later" % e
+            self.queue.set_offline()
+            if worker is not None:
+                worker.close()
+                worker = None
+            self.store_for_upload()
+        finally:
+            if worker is not None:
+                worker.close()
+
+        self.update_sync_state()
+        self.sleep_time = self.fitbit.command_sleep()
+
+    def run_request_chain(self, tracker):
+        pool = None
+        if self.config.keepalive():
+            pool = ConnectionPool(self.config.timeout())
+        conn = FitBitRequest(self.FITBIT_HOST, self.START_PATH,
+                             https=self.FITBIT_HTTPS, pool=pool,
+                             timeout=self.config.timeout())
+
+        # The server may ask for the same reads several times
+        spill = None
+        if self.streaming:
+            spill = tempfile.TemporaryFile()
+        cache = OpcodeCache(tracker, spill)
+
+        if (self.streaming or self.config.dump_connection()) and \
+           self.transcript is None:
+            self.open_transcript()
 
         # Start the request Chain
         self.form_base_info()
-        while conn is not None:
-            self.form_base_info(conn.response)
-
-            self.info_dict.update(conn.run_opcodes(self.fitbit))
-
-            conn.upload(self.info_dict)
-
-            self.data.append(conn.dump())
-            conn = conn.getNext()
+        try:
+            while conn is not None:
+                self.form_base_info(conn.response)
+
+                self.info_dict.update(conn.run_opcodes(cache))
+
+                if isinstance(tracker, SessionCache):
+                    tracker.prefetch()
+                conn.upload(self.info_dict)
+
+                ops = conn.dump()
+                if not self.streaming:
+                    self.data.append(ops)
+                if self.transcript is not None:
+                    self.transcript.add_request(ops)
+                self.newest_records.add_request(ops)
+                conn = conn.getNext()
+        finally:
+            if pool is not None:
+                pool.close()
+            if spill is not None:
+                spill.close()
+        print "Opcode cache:", cache
+        if pool is not None:
+            print "HTTP:", pool
+
+    def store_for_upload(self):
+        """Reads what the server usually asks for, and queues it to be
+        uploaded once the server can be reached"""
+        responses = [(opcode, self.fitbit.run_opcode(opcode))
+                     for opcode in SessionCache.USUAL_OPCODES]
+        name = self.queue.put(responses)
+        print "Sync queued as", name
+
+    def update_sync_state(self):
+        """Moves the high water marks of the banks read during this sync
+        to their newest record. In incremental mode, the banks the
+        server did not erase are erased up to it, so the next sync only
+        transfers what was recorded meanwhile."""
+        # Kept per tracker, several of them can sync to the same account
+        if 'deviceInfo.serialNumber' not in self.log_info:
+            return
+        state = SyncState(self.log_info['deviceInfo.serialNumber'])
+        self.previous_marks = state.high_water_marks()
+        erased = self.newest_records.erased
+        for index, tstamp in sorted(self.newest_records.newest.items()):
+            state.update(index, tstamp)
+            if self.config.incremental() and index not in erased:
+                self.fitbit.erase_data_bank(index, tstamp)
+        state.save()
+
+class StoredUpload(FitBitClient):
+    """Runs the request chain of the server on a sync kept in the
+    UploadQueue, the tracker being long gone."""
+
+    def __init__(self, responses, debug=False):
+        self.queue = None
+        self.info_dict = {}
+        self.log_info = {}
+        self.time = time.time()
+        self.data = []
+        self.previous_marks = {}
+        self.config = client_config.ClientConfig()
+        self.streaming = self.config.streaming()
+        self.transcript = None
+        self.newest_records = NewestRecords()
+        self.owns_base = False
+        self.fitbit = StoredTracker(responses)
 
-        self.fitbit.command_sleep()
+    def run_upload_requests(self):
+        self.run_request_chain(self.fitbit)
 
 class FitBitDaemon(object):
 
-    def __init__(self, debug):
+    def __init__(self, debug, trackers=1):
         self.log_info = {}
         self.log = None
         self.debug = debug
+        self.config = client_config.ClientConfig()
+        #: Syncs done while the server was unreachable
+        self.queue = None
+        if self.config.queue():
+            self.queue = UploadQueue()
+        #: Thread uploading the queued syncs
+        self.drainer = None
+        #: How many trackers are synced at the same time, each on its
+        #: own channel of the base
+        self.trackers = trackers
+        #: Base kept open between syncs, until something goes wrong
+        self.base = None
+        #: High water mark of the resident memory during the last sync,
+        #: in kB
+        self.peak_memory = None
+        #: MetricsServer, if the metrics port is set
+        self.metrics_server = None
+        #: Last ANT calls and messages, written out when a sync fails
+        self.recorder = None
+        if self.config.flight_recorder():
+            self.recorder = FlightRecorder(self.config.flight_recorder())
+        #: When to look for trackers again
+        self.scheduler = SyncScheduler(self.config.min_wait(),
+                                       self.config.max_wait())
+        #: Kept across the bases opened, so are its statistics
+        self.retry = self.config.retry_policy()
+        #: Trackers heard by the scans, if enabled
+        self.discovery = None
+
+    def open_base(self):
+        """Returns the base kept open between syncs, opening and setting
+        it up first if needed. Only the first sync after opening the
+        base has to reset it."""
+        if self.base is not None:
+            return self.base
+        with registry.timer('fitbit_phase_seconds', phase='base_open'):
+            conn = getConn()
+            if conn is None:
+                print "No base found!"
+                exit(1)
+            if self.trackers > 1:
+                base = ANTSession(conn, self.debug, self.trackers)
+            else:
+                base = ANT(conn, debug=self.debug,
+                           readahead=self.config.readahead())
+            if self.recorder is not None:
+                if base.tracer is not None:
+                    base.set_tracer(MultiTracer(base.tracer, self.recorder))
+                else:
+                    base.set_tracer(self.recorder)
+            base.set_retry_policy(self.retry)
+            if self.trackers > 1:
+                base.start()
+            self.base = base
+        return self.base
+
+    def close_base(self):
+        if self.base is None:
+            return
+        print 'Closing USB device'
+        try:
+            self.base.close()
+        except Exception:
+            pass
+        self.base = None
+
+    def upload_stored(self, responses):
+        f = StoredUpload(responses, self.debug)
+        try:
+            f.run_upload_requests()
+        finally:
+            f.close()
+
+    def start_drain(self):
+        """Uploads the queued syncs in the background, while the radio
+        syncs go on"""
+        if self.queue is None or not len(self.queue):
+            return
+        if self.drainer is not None and self.drainer.is_alive():
+            return
+        self.drainer = threading.Thread(target=self.queue.drain,
+                                        args=(self.upload_stored,
+                                              self.config.queue_batch(),
+                                              self.config.queue_concurrency()),
+                                        name="Upload queue")
+        self.drainer.daemon = True
+        self.drainer.start()
+
+    def look_for_trackers(self):
+        """Scans for the trackers in range, so that no time is spent
+        waiting for the beacon of a tracker which isn't there"""
+        base = self.open_base()
+        if self.discovery is None:
+            self.discovery = TrackerDiscovery(base)
+        # The table is kept when the base is opened again
+        self.discovery.base = base
+        with registry.timer('fitbit_phase_seconds', phase='scan'):
+            self.discovery.start()
+            try:
+                seen = self.discovery.scan(self.config.scan_time())
+            finally:
+                self.discovery.stop()
+        print
+        print self.discovery
+        self.scheduler.heard(len(seen))
+        if not seen:
+            raise FitBitBeaconTimeout("No tracker in range")
 
     def do_sync(self):
-        f = FitBitClient(self.debug)
+        f = FitBitClient(self.debug, self.open_base(), self.queue)
         try:
             f.run_upload_requests()
         except:
@@ -256,49 +564,172 @@ class FitBitDaemon(object):
             raise
         f.close()
         self.log_info = f.log_info
+        self.scheduler.synced(f.log_info.get('deviceInfo.serialNumber'),
+                              f.sleep_time)
+
+    def do_concurrent_sync(self):
+        """Syncs up to self.trackers trackers at once, on a session
+        shared by all of them. Trackers which never show up are not
+        errors, the first other error is raised once all syncs are
+        over."""
+        session = self.open_base()
+        errors = []
+        infos = []
+        def sync(channel):
+            try:
+                f = FitBitClient(self.debug, channel, self.queue)
+                try:
+                    f.run_upload_requests()
+                finally:
+                    f.close()
+                    channel.close()
+                infos.append(f.log_info)
+                self.scheduler.synced(
+                    f.log_info.get('deviceInfo.serialNumber'), f.sleep_time)
+            except FitBitBeaconTimeout, e:
+                print e
+            except Exception, e:
+                errors.append(sys.exc_info())
+        threads = [threading.Thread(target=sync, args=(session.channel(),))
+                   for i in range(self.trackers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        if not infos:
+            raise FitBitBeaconTimeout("No tracker synced")
+        # The last one is logged by try_sync
+        for info in infos[:-1]:
+            self.log_info = info
+            self.write_log('SUCCESS')
+        self.log_info = infos[-1]
 
     def try_sync(self):
         import traceback
         import usb
         self.log_info = {}
+        reset_peak_memory()
+        snapshot = registry.snapshot()
+        start = time.time()
+        result = 'error'
+        if self.recorder is not None:
+            self.recorder.clear()
         try:
-            self.do_sync()
+            if self.trackers > 1:
+                self.do_concurrent_sync()
+            else:
+                if self.config.scan():
+                    self.look_for_trackers()
+                self.do_sync()
         except FitBitBeaconTimeout, e:
             # This error is fairly normal, so we don't increase error counter.
             print e
+            self.scheduler.missed()
+            result = 'no_tracker'
         except ANTException, e:
             # For ANT errors, log and increase error counter.
             print "Failed with", e
+            self.scheduler.failed()
             print
             print '-'*60
             traceback.print_exc(file=sys.stdout)
             print '-'*60
             self.write_log('ERROR: ' + str(e))
             self.errors += 1
+            # The state of the base is unknown, start over with it
+            self.close_base()
         except usb.USBError, e:
             # Raise this error up the stack, since USB errors are fairly
             # critical.
             self.write_log('ERROR: ' + str(e))
+            self.close_base()
             raise
         else:
             # Clear error counter after a successful sync.
             print "normal finish"
             self.write_log('SUCCESS')
             self.errors = 0
+            result = 'success'
+        finally:
+            self.peak_memory = peak_memory()
+            print "Memory high water mark: %d kB" % self.peak_memory
+            elapsed = time.time() - start
+            registry.inc('fitbit_syncs_total', result=result)
+            registry.observe('fitbit_phase_seconds', elapsed, phase='sync')
+            if result == 'error':
+                self.dump_flight_recorder()
+            if self.debug:
+                print self.retry
+            if self.config.metrics_summary():
+                self.write_metrics(snapshot, result, elapsed)
+
+    def write_metrics(self, snapshot, result, elapsed):
+        """Appends the metrics of the sync to the summary file"""
+        summary = registry.summary(snapshot)
+        summary.update({'time': int(time.time()), 'result': result,
+                        'seconds': elapsed,
+                        'peak_memory_kb': self.peak_memory,
+                        'tracker': self.log_info.get('deviceInfo.serialNumber')})
+        try:
+            write_summary(summary)
+        except (IOError, OSError), e:
+            print "Could not write the metrics summary:", e
+
+    def dump_flight_recorder(self, directory='~/.fitbit'):
+        """Writes what the flight recorder kept of the failed sync,
+        returns the path of the file"""
+        if self.recorder is None:
+            return None
+        directory = os.path.expanduser(directory)
+        path = os.path.join(directory, 'flight-%d.txt' % int(time.time()))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            f = open(path, 'w')
+            self.recorder.dump(f)
+            f.close()
+        except (IOError, OSError), e:
+            print "Could not write the flight recorder:", e
+            return None
+        print "Last ANT traffic written to", path
+        return path
+
+    def start_metrics_server(self):
+        port = self.config.metrics_port()
+        if not port:
+            return
+        try:
+            self.metrics_server = MetricsServer(port)
+        except socket.error, e:
+            print "Could not serve the metrics on port %d: %s" % (port, e)
+            return
+        self.metrics_server.start()
 
     def run(self, args):
         sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
         self.errors = 0
+        self.start_metrics_server()
         
         while self.errors < 3:
+            self.start_drain()
             self.open_log()
             self.try_sync()
             self.close_log()
             if args.once:
+                self.start_drain()
+                if self.drainer is not None:
+                    self.drainer.join()
                 print "I'm done"
+                self.close_base()
                 return
-            time.sleep(3)
+            wait = self.scheduler.next_wait()
+            if wait > 0:
+                print "Looking for trackers again in %d seconds" % wait
+                time.sleep(wait)
         
+        self.close_base()
         print 'exiting due to earlier failure'
         sys.exit(1)
 
@@ -325,7 +756,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--once", help="Run the request only once", action="store_true")
     parser.add_argument("--debug", help="Display debug information", action="store_true")
+    parser.add_argument("--trackers", help="Sync up to this many trackers at the same time", type=int, default=1)
     args = parser.parse_args()
-    FitBitDaemon(args.debug).run(args)
+    FitBitDaemon(args.debug, args.trackers).run(args)
 
 # vim: set ts=4 sw=4 expandtab:
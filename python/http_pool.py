@@ -0,0 +1,99 @@
+#################################################################
+# http connection pool
+# Keeps one persistent HTTP(S) connection per host, so that the
+# round trips of a sync don't each pay for a TCP and TLS handshake.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import httplib, socket, errno, urllib2, urlparse
+
+class ConnectionPool(object):
+    """HTTP/1.1 connections kept alive between requests, one per
+    scheme, host and port. A request on a connection the server closed
+    meanwhile is sent again on a new one, only if it failed before any
+    response came, so that nothing gets uploaded twice.
+
+    """
+
+    HEADERS = {'Content-Type': 'application/x-www-form-urlencoded',
+               'Connection': 'keep-alive'}
+
+    def __init__(self, timeout = 30):
+        self.timeout = timeout
+        #: (scheme, host, port) -> connection
+        self._connections = {}
+        #: new connections opened, and requests sent
+        self.connects = 0
+        self.requests = 0
+
+    def _connection(self, scheme, netloc):
+        key = (scheme, netloc)
+        conn = self._connections.get(key)
+        if conn is None:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            self._connections[key] = conn
+            self.connects += 1
+        return conn
+
+    def _stale(self, e):
+        """Tells if e is how a request fails on a kept alive connection
+        the server closed, before it got the request"""
+        if isinstance(e, httplib.BadStatusLine):
+            return True
+        return isinstance(e, socket.error) and \
+               not isinstance(e, socket.timeout) and \
+               e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+    def _drop(self, scheme, netloc):
+        conn = self._connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def post(self, url, data):
+        """Posts data to url, returns the body of the response. Raises
+        urllib2.HTTPError like urlopen() for error statuses."""
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        for tries in range(2):
+            fresh = (parts.scheme, parts.netloc) not in self._connections
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('POST', path, data, self.HEADERS)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                self._drop(parts.scheme, parts.netloc)
+                if fresh or not self._stale(e):
+                    raise
+                # The server closed the connection since the last
+                # request, try again on a new one
+                continue
+            try:
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                # The server got the request, it isn't sent again
+                self._drop(parts.scheme, parts.netloc)
+                raise
+            self.requests += 1
+            if response.will_close:
+                self._drop(parts.scheme, parts.netloc)
+            if response.status >= 400:
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, None)
+            return body
+
+    def close(self):
+        for key in self._connections.keys():
+            self._drop(*key)
+
+    def __str__(self):
+        return "%d requests on %d connections" % (self.requests, self.connects)
+
+# vim: set ts=4 sw=4 expandtab:
@@ -0,0 +1,61 @@
+#################################################################
+# metrics exporter
+# Serves the metrics of the daemon to Prometheus on localhost, and
+# appends a JSON summary of each sync to a file.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import os, json, threading
+import BaseHTTPServer
+from antprotocol.metrics import registry
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the output of the daemon
+        pass
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """Serves registry at http://127.0.0.1:port/metrics, from a
+    background thread once started"""
+
+    def __init__(self, port, registry=registry, host='127.0.0.1'):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.registry = registry
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name="Metrics server")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def write_summary(summary, path='~/.fitbit/sync_metrics.json'):
+    """Appends summary as one line of JSON to path"""
+    path = os.path.expanduser(path)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    f = open(path, 'a')
+    f.write(json.dumps(summary, sort_keys=True) + '\n')
+    f.close()
+
+# vim: set ts=4 sw=4 expandtab:
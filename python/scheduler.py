@@ -0,0 +1,82 @@
+#################################################################
+# sync scheduler
+# Decides how long the daemon waits before looking for trackers
+# again, from when each of them was told to go to sleep, instead of
+# polling the base every few seconds.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import time
+
+class SyncScheduler(object):
+    """Keeps the time of the last sync of each tracker, and how long it
+    was told to sleep for. Trackers don't beacon while they sleep, so
+    there is no point in listening for them before they wake up. While
+    no tracker is found, the wait between two tries doubles, from
+    min_wait up to max_wait seconds.
+
+    """
+
+    def __init__(self, min_wait=3, max_wait=300, clock=time.time):
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.clock = clock
+        #: tracker id -> (time of the last sync, seconds asleep after it)
+        self.trackers = {}
+        #: Wait after the next try if it finds no tracker
+        self.idle_wait = min_wait
+        #: Trackers heard by the last scan, and not synced since
+        self.awake = 0
+
+    def synced(self, tracker_id, sleep):
+        """Notes the sync of tracker_id, which was told to sleep for
+        sleep seconds"""
+        self.trackers[tracker_id] = (self.clock(), sleep)
+        self.idle_wait = self.min_wait
+        self.awake = max(self.awake - 1, 0)
+
+    def heard(self, count):
+        """Notes that a scan heard count trackers, which are synced
+        right away"""
+        self.awake = count
+
+    def missed(self):
+        """Notes a try which found no tracker. The trackers which were
+        expected are gone, until they show up again."""
+        now = self.clock()
+        for tracker_id, (last, sleep) in self.trackers.items():
+            if last + sleep <= now:
+                del self.trackers[tracker_id]
+        self.idle_wait = min(self.idle_wait * 2, self.max_wait)
+        self.awake = 0
+
+    def failed(self):
+        """Notes a try which went wrong, to be tried again soon"""
+        self.idle_wait = self.min_wait
+
+    def wake_times(self):
+        """Returns the times at which the sleeping trackers wake up,
+        soonest first"""
+        now = self.clock()
+        return sorted(last + sleep for last, sleep in self.trackers.values()
+                      if last + sleep > now)
+
+    def next_wait(self):
+        """Returns the seconds to wait before the next try: none if a
+        tracker is expected or was heard and not synced yet, until the
+        first one wakes up if all the trackers known are asleep, but no
+        more than max_wait so that new trackers are looked for, or the
+        idle wait if none is known."""
+        if self.awake:
+            return 0
+        wakes = self.wake_times()
+        if len(wakes) < len(self.trackers):
+            return 0
+        if wakes:
+            return min(wakes[0] - self.clock(), self.max_wait)
+        return self.idle_wait
+
+# vim: set ts=4 sw=4 expandtab:
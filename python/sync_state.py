@@ -0,0 +1,82 @@
+import ConfigParser, os
+import bank_decoder
+
+class SyncState(object):
+    """
+    Per tracker state kept between syncs, in ~/.fitbit/<tracker_id>/state
+
+    [high_water_marks]
+    0 = 1341154923
+    6 = 1341154923
+
+    The high water mark of a bank is the timestamp of the newest record
+    of it already stored, everything up to it can be erased from the
+    tracker.
+    """
+
+    SECTION = 'high_water_marks'
+
+    def __init__(self, tracker_id, directory='~/.fitbit'):
+        self.directory = os.path.join(os.path.expanduser(directory), tracker_id)
+        self.path = os.path.join(self.directory, 'state')
+        self.parser = ConfigParser.SafeConfigParser()
+        if os.path.exists(self.path):
+            self.parser.read(self.path)
+        if not self.parser.has_section(self.SECTION):
+            self.parser.add_section(self.SECTION)
+
+    def high_water_mark(self, index):
+        """Returns the high water mark of bank index, or None"""
+        if not self.parser.has_option(self.SECTION, str(index)):
+            return None
+        return self.parser.getint(self.SECTION, str(index))
+
+    def high_water_marks(self):
+        """Returns a dict bank index -> high water mark"""
+        return dict((int(index), int(tstamp))
+                    for index, tstamp in self.parser.items(self.SECTION))
+
+    def update(self, index, tstamp):
+        """Moves the high water mark of bank index forward to tstamp"""
+        current = self.high_water_mark(index)
+        if current is None or tstamp > current:
+            self.parser.set(self.SECTION, str(index), str(tstamp))
+
+    def save(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        f = open(self.path, 'w')
+        self.parser.write(f)
+        f.close()
+
+class NewestRecords(object):
+    """
+    Timestamps of the newest records of the banks read during one sync,
+    noted as the requests are done, so that the bank contents don't
+    have to be kept until the end of the sync.
+    """
+
+    def __init__(self):
+        self.hardware_version = 12
+        #: bank index -> timestamp of its newest record
+        self.newest = {}
+        #: banks erased since they were last read
+        self.erased = set()
+
+    def add_request(self, ops):
+        """Notes the ops of one request, as returned by
+        FitBitRequest.dump()"""
+        for op in ops:
+            opcode = op['request']['opcode']
+            if op['status'] != 'success':
+                continue
+            if opcode[0] == 0x24 and len(op['response']) > 5:
+                self.hardware_version = op['response'][5]
+            elif opcode[0] == 0x22 and opcode[1] in bank_decoder.DECODERS:
+                tstamp = bank_decoder.decode(opcode[1], op['response'],
+                                             self.hardware_version).newest()
+                if tstamp is not None:
+                    self.newest[opcode[1]] = tstamp
+                self.erased.discard(opcode[1])
+            elif opcode[0] == 0x25:
+                self.erased.add(opcode[1])
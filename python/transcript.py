@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#################################################################
+# sync transcripts
+# Records the opcodes run during a sync and the responses of the
+# tracker, as they come, in an append-only binary file.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+#
+# File layout, all integers little endian:
+#
+#   'FBTRANS1'
+#   records:  request index (2), status (1, 1 for success), opcode (7),
+#             payload length (2, 0xffff for none), response length (4),
+#             payload, response
+#   'FBINDEX1', amount of entries (4), entries: opcode (7), offset of
+#             the record (8), sorted by opcode
+#   trailer:  offset of the index (8), 'FBTRAIL1'
+#
+# The index and trailer are written when the sync is over. A file
+# without them (the sync got interrupted) is read record by record.
+
+import os, sys, struct
+
+MAGIC = 'FBTRANS1'
+INDEX_MAGIC = 'FBINDEX1'
+TRAILER_MAGIC = 'FBTRAIL1'
+RECORD = struct.Struct('<HB7sHI')
+INDEX_ENTRY = struct.Struct('<7sQ')
+TRAILER = struct.Struct('<Q8s')
+NO_PAYLOAD = 0xffff
+
+def _pack(values):
+    return str(bytearray(values))
+
+def _unpack(data):
+    return list(bytearray(data))
+
+class TranscriptWriter(object):
+    """Appends the operations of a sync to a transcript file, flushing
+    each of them so that an interrupted sync leaves a readable file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._index = []
+        self._request = 0
+
+    def add_request(self, ops):
+        """Appends the dumps of the ops of one request, as returned by
+        FitBitRequest.dump()"""
+        for op in ops:
+            self.add(self._request, op)
+        self._request += 1
+
+    def add(self, request, op):
+        opcode = _pack(op['request']['opcode']).ljust(7, '\0')
+        payload = op['request'].get('payload')
+        response = op['response'] or []
+        self._index.append((opcode, self._file.tell()))
+        self._file.write(RECORD.pack(
+            request, 1 if op['status'] == 'success' else 0, opcode,
+            NO_PAYLOAD if payload is None else len(payload), len(response)))
+        if payload is not None:
+            self._file.write(_pack(payload))
+        self._file.write(_pack(response))
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        offset = self._file.tell()
+        self._index.sort()
+        self._file.write(INDEX_MAGIC + struct.pack('<I', len(self._index)))
+        for entry in self._index:
+            self._file.write(INDEX_ENTRY.pack(*entry))
+        self._file.write(TRAILER.pack(offset, TRAILER_MAGIC))
+        self._file.close()
+        self._file = None
+
+class Transcript(object):
+    """Reads a transcript file, without loading it all at once."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a transcript" % path)
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+        #: Offset where the records end, and the index if there is one
+        self.end = size
+        self.index = None
+        if size >= len(MAGIC) + TRAILER.size:
+            self._file.seek(size - TRAILER.size)
+            offset, magic = TRAILER.unpack(self._file.read(TRAILER.size))
+            if magic == TRAILER_MAGIC:
+                self.end = offset
+                self.index = self._read_index(offset)
+
+    def _read_index(self, offset):
+        self._file.seek(offset)
+        header = self._file.read(len(INDEX_MAGIC) + 4)
+        count = struct.unpack('<I', header[len(INDEX_MAGIC):])[0]
+        data = self._file.read(count * INDEX_ENTRY.size)
+        return [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size)
+                for i in range(count)]
+
+    def close(self):
+        self._file.close()
+
+    def _read_record(self, offset):
+        """Returns (request index, op dump, offset of the next record),
+        or None if there is no complete record at offset"""
+        self._file.seek(offset)
+        header = self._file.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return None
+        request, status, opcode, payload_len, response_len = \
+            RECORD.unpack(header)
+        payload = None
+        if payload_len != NO_PAYLOAD:
+            payload = _unpack(self._file.read(payload_len))
+        response = self._file.read(response_len)
+        if len(response) < response_len:
+            return None
+        op = {'request': {'opcode': _unpack(opcode), 'payload': payload},
+              'status': 'success' if status else 'failed',
+              'response': _unpack(response)}
+        return request, op, self._file.tell()
+
+    def __iter__(self):
+        """Yields (request index, op dump) in the order they were run"""
+        offset = len(MAGIC)
+        while offset < self.end:
+            record = self._read_record(offset)
+            if record is None:
+                # Cut in the middle of a record
+                return
+            request, op, offset = record
+            yield request, op
+
+    def requests(self):
+        """Returns the ops grouped by request, as in a connection dump"""
+        result = []
+        for request, op in self:
+            while len(result) <= request:
+                result.append([])
+            result[request].append(op)
+        return result
+
+    def find(self, *prefix):
+        """Yields the ops whose opcode starts with prefix, using the
+        index when there is one"""
+        key = _pack(prefix)
+        if self.index is None:
+            for request, op in self:
+                if _pack(op['request']['opcode']).startswith(key):
+                    yield op
+            return
+        for opcode, offset in self.index:
+            if opcode.startswith(key):
+                yield self._read_record(offset)[1]
+
+def is_transcript(path):
+    f = open(path, 'rb')
+    magic = f.read(len(MAGIC))
+    f.close()
+    return magic == MAGIC
+
+def read_dump(path):
+    """Returns the requests of a transcript or of a YAML connection
+    dump"""
+    if is_transcript(path):
+        transcript = Transcript(path)
+        requests = transcript.requests()
+        transcript.close()
+        return requests
+    import yaml
+    f = open(path)
+    data = yaml.load(f.read())
+    f.close()
+    return data or []
+
+def convert_yaml(yaml_path, path=None):
+    """Writes the YAML connection dump yaml_path as a transcript,
+    returns the path of the transcript"""
+    if path is None:
+        path = os.path.splitext(yaml_path)[0] + '.fbt'
+    writer = TranscriptWriter(path)
+    for ops in read_dump(yaml_path):
+        writer.add_request(ops)
+    writer.close()
+    return path
+
+def main():
+    if len(sys.argv) < 2:
+        print "Usage: %s connection-dump.txt [transcript.fbt]" % sys.argv[0]
+        print "Converts YAML connection dumps to transcripts"
+        sys.exit(1)
+    print convert_yaml(*sys.argv[1:3])
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sw=4 expandtab:
@@ -0,0 +1,174 @@
+#################################################################
+# upload queue
+# Keeps the tracker responses of the syncs done while the fitbit
+# server was unreachable, until they can be uploaded.
+#
+# Distributed as part of the libfitbit project
+#
+# Licensed under the BSD License, see LICENSE.txt
+#################################################################
+
+import os, json, time, threading, Queue
+import socket, httplib, urllib2
+from antprotocol.protocol import ANTException
+
+def uplink_failure(e):
+    """Tells if exception e means the server couldn't be reached, or
+    failed on its side, rather than something wrong with what was
+    uploaded"""
+    if isinstance(e, urllib2.HTTPError):
+        return e.code >= 500
+    return isinstance(e, (urllib2.URLError, httplib.HTTPException,
+                          socket.error))
+
+class StoredTracker(object):
+    """Answers the opcodes of the server with the responses recorded
+    during an offline sync. Has the run_opcode() of a FitBit."""
+
+    def __init__(self, responses):
+        #: opcode -> response
+        self.responses = dict((tuple(opcode), response)
+                              for opcode, response in responses)
+
+    def run_opcode(self, opcode, payload = [], consumer = None):
+        response = self.responses.get(tuple(opcode))
+        if response is None:
+            # Writes and erases can only be done with the tracker around
+            raise ANTException("Opcode %s not recorded" % opcode)
+        return list(response)
+
+class UploadQueue(object):
+    """Directory of pending uploads, one JSON file per sync, named by
+    the time of the sync so that they are uploaded in order. Files are
+    written under a temporary name then renamed, so that a crash never
+    leaves half an entry. Entries the server refuses, or fails on
+    max_attempts times, are moved to the failed subdirectory.
+
+    """
+
+    def __init__(self, directory='~/.fitbit/queue', max_attempts=5,
+                 recheck=300):
+        self.directory = os.path.expanduser(directory)
+        self.max_attempts = max_attempts
+        #: Seconds during which syncs are queued without trying the
+        #: server, after it couldn't be reached
+        self.recheck = recheck
+        self._offline_until = 0
+        #: name -> failed uploads of the entry
+        self.attempts = {}
+        self._lock = threading.Lock()
+
+    @property
+    def offline(self):
+        """True while the server is known to be unreachable, syncs are
+        then queued without trying to upload them first"""
+        return time.time() < self._offline_until
+
+    def set_offline(self, offline=True):
+        """Notes that the server couldn't be reached, or could"""
+        self._offline_until = time.time() + self.recheck if offline else 0
+
+    def put(self, responses):
+        """Queues a list of (opcode, response), returns the name of the
+        entry"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with self._lock:
+            name = '%.6f.json' % time.time()
+            path = os.path.join(self.directory, name)
+            f = open(path + '.tmp', 'w')
+            json.dump({'time': time.time(),
+                       'responses': [[list(opcode), list(response)]
+                                     for opcode, response in responses]}, f)
+            f.close()
+            os.rename(path + '.tmp', path)
+        return name
+
+    def names(self):
+        """Returns the names of the queued entries, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.json'))
+
+    def __len__(self):
+        return len(self.names())
+
+    def get(self, name):
+        """Returns the (opcode, response) list of entry name"""
+        f = open(os.path.join(self.directory, name))
+        entry = json.load(f)
+        f.close()
+        return entry['responses']
+
+    def remove(self, name):
+        os.remove(os.path.join(self.directory, name))
+        self.attempts.pop(name, None)
+
+    def set_aside(self, name):
+        """Moves entry name to the failed subdirectory, where it is
+        kept but never uploaded again"""
+        failed = os.path.join(self.directory, 'failed')
+        if not os.path.isdir(failed):
+            os.makedirs(failed)
+        os.rename(os.path.join(self.directory, name),
+                  os.path.join(failed, name))
+        self.attempts.pop(name, None)
+
+    def drain(self, upload, batch=8, concurrency=2):
+        """Uploads the queued entries, batch at a time, concurrency of
+        them at once, by calling upload(responses). An entry is removed
+        once uploaded. Stops after the first batch where the server
+        couldn't be reached, and returns the amount of entries uploaded.
+        Entries failing for other reasons are set aside."""
+        uploaded = 0
+        while True:
+            names = self.names()[:batch]
+            if not names:
+                self.set_offline(False)
+                return uploaded
+            pending = Queue.Queue()
+            for name in names:
+                pending.put(name)
+            failures = []
+            def run():
+                while True:
+                    try:
+                        name = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        upload(self.get(name))
+                    except Exception, e:
+                        failures.append((name, e))
+                        continue
+                    self.remove(name)
+            threads = [threading.Thread(target=run)
+                       for i in range(min(concurrency, len(names)))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            uploaded += len(names) - len(failures)
+            offline = False
+            for name, e in failures:
+                if not uplink_failure(e):
+                    print "Setting queued sync %s aside: %r" % (name, e)
+                    self.set_aside(name)
+                    continue
+                offline = True
+                if isinstance(e, urllib2.HTTPError):
+                    # The server may fail on this entry every time
+                    attempts = self.attempts.get(name, 0) + 1
+                    self.attempts[name] = attempts
+                    if attempts >= self.max_attempts:
+                        print "Setting queued sync %s aside after %d " \
+                              "server errors" % (name, attempts)
+                        self.set_aside(name)
+            if offline:
+                print "Failed to upload %d queued syncs: %s" % (
+                    len(failures), failures[0][1])
+                self.set_offline()
+                return uploaded
+
+# vim: set ts=4 sw=4 expandtab: